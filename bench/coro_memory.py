@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+协程任务表内存检查：持续提交大量任务，确认已结束的任务不会被Coro长期引用，常驻内存保持平稳
+
+    python -m bench.coro_memory --tasks 1000000
+"""
+
+import argparse
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.coro import Coro  # noqa: E402
+
+
+def rss_mb():
+    # /proc中的当前常驻内存，其他平台退回到峰值
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def fake_task(i):
+    # 模拟一个持有完整输出的采集任务
+    return {'id': i, 'stdout': 'x' * 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--sem', type=int, default=40)
+    parser.add_argument('--tolerance', type=float, default=20, help='allowed rss growth in MB after warm up')
+    args = parser.parse_args()
+
+    coro = Coro(sem=args.sem, daemon=True)
+    coro.start()
+    baseline = None
+    start = time.time()
+    for n in range(0, args.tasks, args.batch):
+        for i in range(n, min(n + args.batch, args.tasks)):
+            coro.add_task(fake_task(i), sem=True, key=i)
+        while coro.done < min(n + args.batch, args.tasks):
+            time.sleep(0.01)
+        if baseline is None and n >= args.batch * 5:
+            baseline = rss_mb()
+        if n % (args.batch * 10) == 0:
+            print('{:>9} tasks  rss {:8.1f} MB  table {}  keys {}  history {}'.format(
+                coro.done, rss_mb(), len(coro.tasks), len(coro.keys), len(coro.history)))
+    growth = rss_mb() - (baseline or rss_mb())
+    print('{} tasks in {:.1f}s, rss growth after warm up {:.1f} MB'.format(coro.done, time.time() - start, growth))
+    assert not coro.tasks and not coro.keys, 'finished tasks are still referenced'
+    assert growth < args.tolerance, 'rss grew {:.1f} MB'.format(growth)
+
+
+if __name__ == '__main__':
+    main()
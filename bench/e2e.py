@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+端到端吞吐基准：本地asyncssh/telnetlib3替身服务 + kombu内存传输，经Dispatcher.handle_msg驱动gather任务，
+输出tasks/sec、p50/p99延迟、峰值RSS与CPU，结果保存为JSON便于跨提交对比
+
+    python -m bench.e2e --tasks 5000 --proto mixed --latency 0.01 --size 4096
+    python -m bench.e2e --tasks 1000 --proto ssh --stream --accept-encoding zlib
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from kombu import Connection, Exchange, Producer, Queue  # noqa: E402
+
+from core import rabbitmq  # noqa: E402
+from core.context import Context  # noqa: E402
+from core.dispatch import Dispatcher  # noqa: E402
+from utils.compress_utils import RESULT_CONTENT_TYPE, unpack_result  # noqa: E402
+
+USERNAME, PASSWORD = 'bench', 'bench'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def serve(ssh_port, telnet_port, latency, size, ready):
+    # 替身服务运行在子进程中，不占用被测进程的CPU
+    import asyncssh
+    import telnetlib3
+
+    output = ('x' * 63 + '\n') * (size // 64) + 'x' * (size % 64)
+
+    class Server(asyncssh.SSHServer):
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return password == PASSWORD
+
+    async def ssh_handler(process):
+        await asyncio.sleep(latency)
+        process.stdout.write(output)
+        process.exit(0)
+
+    async def readline(reader):
+        line = ''
+        while True:
+            ch = await reader.read(1)
+            if not ch:
+                return None
+            if ch in '\r\n':
+                if line:
+                    return line
+                continue
+            line += ch
+
+    async def telnet_shell(reader, writer):
+        writer.write('login: ')
+        await readline(reader)
+        writer.write('Password: ')
+        if await readline(reader) != PASSWORD:
+            writer.write('\r\nLogin incorrect\r\n')
+            writer.close()
+            return
+        writer.write('\r\nWelcome\r\nbench# ')
+        while True:
+            cmd = await readline(reader)
+            if cmd is None:
+                break
+            await asyncio.sleep(latency)
+            writer.write('\r\n' + output.replace('\n', '\r\n') + '\r\nbench# ')
+        writer.close()
+
+    async def main():
+        key = asyncssh.generate_private_key('ssh-ed25519')
+        await asyncssh.create_server(Server, '0.0.0.0', ssh_port, server_host_keys=[key],
+                                     process_factory=ssh_handler, reuse_address=True)
+        await telnetlib3.create_server(host='0.0.0.0', port=telnet_port, shell=telnet_shell)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+class MemoryBroker(rabbitmq.Broker):
+    @property
+    def amqp(self):
+        return 'memory://'
+
+    def _check(self):
+        pass
+
+
+def setup(args):
+    Context.CONF = {
+        'VERSION': 'bench',
+        'MQ_CONFIG': {},
+        'COROUTINE_CONFIG': {'sem': args.sem},
+        'SCHEDULER_CONFIG': {'per_host': args.per_host},
+        'PUBLISHER_CONFIG': {'enable': not args.no_publisher},
+        'METRICS_CONFIG': {'enable': False},
+    }
+    ctx = Context(None)
+    ctx.broker = MemoryBroker()
+    exchange = Exchange('bench', 'direct')
+    ctx.broker.queues = {'bench': Queue('bench', exchange, 'bench')}
+    ctx.mq = rabbitmq.RabbitMQ(ctx.broker, cb=Dispatcher.handle_msg)
+    ctx.register_publisher()
+    ctx.register_coroutine()
+    ctx.register_pool()
+    return ctx
+
+
+def make_body(i, args):
+    proto = args.proto if args.proto != 'mixed' else ('ssh', 'telnet')[i % 2]
+    ip = '127.0.{}.{}'.format(1 + (i % args.hosts) // 250, 1 + (i % args.hosts) % 250)
+    body = {'id': 'bench-{}'.format(i), 'type': 'gather', 'encoding': 'utf-8',
+            'account': {'username': USERNAME, 'password': PASSWORD},
+            'conn': {'ip': ip, 'port': args.ssh_port if proto == 'ssh' else args.telnet_port, 'proto': proto},
+            'task': {'cmd': 'bench', 'mto': 30}}
+    if args.stream:
+        body['task']['stream'] = True
+    if args.accept_encoding:
+        # 不指定encoding，输出按原始数据返回，较大的结果以压缩消息体发布
+        del body['encoding']
+        body['task']['accept_encoding'] = args.accept_encoding
+    return body
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.ssh_port, args.telnet_port, args.latency, args.size,
+                                                         ready), daemon=True)
+    server.start()
+    if not ready.wait(30):
+        raise RuntimeError('stand-in servers did not start')
+
+    ctx = setup(args)
+    reply = Queue('bench-reply', Exchange('reply', 'direct'), 'bench-reply')
+    sent = {}
+    with Connection('memory://') as conn:
+        channel = conn.default_channel
+        reply(channel).declare()
+        task_queue = ctx.broker.queues['bench']
+        task_queue(channel).declare()
+        producer = Producer(channel)
+        for i in range(args.tasks):
+            body = make_body(i, args)
+            producer.publish(body, exchange=task_queue.exchange, routing_key='bench', reply_to='reply/bench-reply')
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_start = usage.ru_utime + usage.ru_stime
+    start = time.perf_counter()
+    for i in range(args.tasks):
+        sent['bench-{}'.format(i)] = start
+    ctx.mq.run(thread=True, no_ack=False, prefetch_count=ctx.coroutine.capacity,
+               prefetch_limit=ctx.coroutine.scheduler.prefetch)
+
+    latencies, totals, codes, chunks = [], [], Counter(), 0
+    with Connection('memory://') as conn:
+        queue = reply(conn.default_channel)
+        deadline = time.perf_counter() + args.timeout
+        while len(latencies) < args.tasks and time.perf_counter() < deadline:
+            message = queue.get(no_ack=True)
+            if message is None:
+                time.sleep(0.001)
+                continue
+            now = time.perf_counter()
+            if message.content_type == RESULT_CONTENT_TYPE:
+                data = unpack_result(message.body, message.headers or {}, message.content_encoding)
+            else:
+                data = message.payload
+            if 'seq' in data:
+                # 流式任务的输出分片，最终结果另行回复
+                chunks += 1
+                continue
+            if data.get('id') not in sent:
+                continue
+            latencies.append(now - sent.pop(data['id']))
+            codes[data.get('code')] += 1
+            if data.get('timing'):
+                totals.append(data['timing'].get('total'))
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_start
+    ctx.mq.is_running = False
+    server.terminate()
+
+    done = len(latencies)
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': vars(args),
+        'tasks': done,
+        'missing': args.tasks - done,
+        'elapsed': round(elapsed, 3),
+        'tasks_per_sec': round(done / elapsed, 1) if elapsed else None,
+        # 所有消息同时入队，端到端延迟包含排队时间；task_total为结果中记录的任务自身耗时
+        'latency': {'p50': percentile(latencies, 50), 'p99': percentile(latencies, 99),
+                    'max': max(latencies) if latencies else None},
+        'task_total': {'p50': percentile(totals, 50), 'p99': percentile(totals, 99)},
+        'codes': {str(k): v for k, v in codes.items()},
+        'chunks': chunks,
+        'cpu_seconds': round(cpu, 3),
+        'cpu_percent': round(cpu / elapsed * 100, 1) if elapsed else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end gather throughput benchmark')
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--proto', choices=('ssh', 'telnet', 'mixed'), default='ssh')
+    parser.add_argument('--hosts', type=int, default=50, help='distinct loopback addresses to spread tasks over')
+    parser.add_argument('--latency', type=float, default=0.01, help='command latency of the stand-in servers')
+    parser.add_argument('--size', type=int, default=1024, help='command output size in bytes')
+    parser.add_argument('--sem', type=int, default=200)
+    parser.add_argument('--per-host', type=int, default=4)
+    parser.add_argument('--no-publisher', action='store_true')
+    parser.add_argument('--stream', action='store_true', help='stream output as sequenced chunks')
+    parser.add_argument('--accept-encoding', help='request raw output compressed with this codec, e.g. zlib')
+    parser.add_argument('--ssh-port', type=int, default=18022)
+    parser.add_argument('--telnet-port', type=int, default=18023)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', help='json result path, default bench/results/e2e-<commit>-<time>.json')
+    args = parser.parse_args()
+
+    result = run(args)
+    output = Path(args.output) if args.output else ROOT / 'bench' / 'results' / 'e2e-{}-{}.json'.format(
+        result['commit'] or 'nogit', time.strftime('%Y%m%d%H%M%S'))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(json.dumps({k: v for k, v in result.items() if k != 'params'}, indent=2))
+    print('saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+序列化微基准：在任务消息、单条采集结果、多命令结果和大输出结果上比较标准库json、orjson与msgpack的编解码耗时
+
+    python -m bench.serializer --number 20000
+"""
+
+import argparse
+import json
+import sys
+import time
+import timeit
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import serialize_utils  # noqa: E402
+
+
+def payloads():
+    output = ('drwxr-xr-x  2 root root  4096 Jan  1 00:00 bin\n' * 80)
+    task = {'id': str(uuid.uuid4()), 'type': 'gather', 'encoding': 'utf-8', 'batch_id': 'batch-1',
+            'account': {'username': 'admin', 'password': 'secret'},
+            'conn': {'ip': '10.12.0.15', 'port': 22, 'proto': 'ssh', 'sys_type': 'linux'},
+            'task': {'cmd': 'ls -l /', 'mto': 100}}
+    result = {'id': task['id'], 'cmd': 'ls -l /', 'encoding': 'utf-8', 'stdout': output, 'stderr': '',
+              'returncode': 0, 'code': 0, 'err_info': '', 'start_time': time.time(), 'end_time': time.time(),
+              'timing': {'queue': 0.0012, 'connect': 0.021, 'exec': 0.35, 'decode': 0.0001, 'total': 0.38}}
+    multi = dict(result, cmd=['uname -a'] * 20, stdout='',
+                 results=[{'cmd': 'uname -a', 'stdout': 'Linux host 5.15.0 x86_64 GNU/Linux\n', 'stderr': '',
+                           'returncode': 0, 'code': 0, 'err_info': ''} for _ in range(20)])
+    large = dict(result, stdout=output * 50)
+    return {'task': task, 'result': result, 'multi': multi, 'large': large}
+
+
+def candidates():
+    found = {'json': (serialize_utils._json_dumps, serialize_utils._json_loads)}
+    if serialize_utils.orjson is not None:
+        found['orjson'] = (serialize_utils._orjson_dumps, serialize_utils._orjson_loads)
+    if serialize_utils.msgpack is not None:
+        found['msgpack'] = (serialize_utils._msgpack_dumps, serialize_utils._msgpack_loads)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serializer microbenchmark')
+    parser.add_argument('--number', type=int, default=20000, help='iterations per payload, scaled down by size')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    results = []
+    for name, data in payloads().items():
+        for impl, (dumps, loads) in candidates().items():
+            body = dumps(data)
+            assert loads(body) == json.loads(serialize_utils._json_dumps(data)), '{} roundtrip differs'.format(impl)
+            number = max(100, args.number * 1024 // max(1024, len(body)))
+            encode = min(timeit.repeat(lambda: dumps(data), number=number, repeat=3)) / number
+            decode = min(timeit.repeat(lambda: loads(body), number=number, repeat=3)) / number
+            results.append({'payload': name, 'impl': impl, 'bytes': len(body),
+                            'encode_us': round(encode * 1e6, 2), 'decode_us': round(decode * 1e6, 2)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:<8} {:<8} {:>9} {:>11} {:>11}'.format('payload', 'impl', 'bytes', 'encode(us)', 'decode(us)'))
+    for r in results:
+        print('{payload:<8} {impl:<8} {bytes:>9} {encode_us:>11} {decode_us:>11}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
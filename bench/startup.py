@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：在全新子进程中测量导入core的耗时、从进程启动到消费第一条消息的耗时，
+以及第一条任务回复的耗时(包含协议库的延迟导入)，多次运行取中位数
+
+    python -m bench.startup --repeat 5 --proto ssh --prewarm ssh
+"""
+
+import time
+
+T0 = time.perf_counter()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+PORTS = {'ssh': 22, 'telnet': 23, 'winrm': 5985}
+
+
+def child(args):
+    # 子进程：测量各阶段距进程内T0的耗时，结果以一行json输出
+    sys.path.insert(0, str(ROOT))
+    start = time.perf_counter()
+    import core  # noqa: F401
+    imported = time.perf_counter()
+
+    from kombu import Connection, Exchange, Producer, Queue
+    from bench.e2e import MemoryBroker
+    from core import rabbitmq
+    from core.context import Context
+    from core.dispatch import Dispatcher
+
+    Context.CONF = {'VERSION': 'bench', 'MQ_CONFIG': {}, 'PUBLISHER_CONFIG': {'enable': False},
+                    'METRICS_CONFIG': {'enable': False},
+                    'STARTUP_CONFIG': {'prewarm': args.prewarm, 'background': not args.sync_prewarm}}
+    ctx = Context(None)
+    ctx.broker = MemoryBroker()
+    ctx.broker.queues = {'startup': Queue('startup', Exchange('startup', 'direct'), 'startup')}
+    reply = Queue('startup-reply', Exchange('reply', 'direct'), 'startup-reply')
+    marks = {}
+
+    def on_message(body, message):
+        marks.setdefault('first_consume', time.perf_counter())
+        Dispatcher.handle_msg(body, message)
+
+    ctx.mq = rabbitmq.RabbitMQ(ctx.broker, cb=on_message)
+    ctx.register_coroutine()
+    ctx.register_pool()
+    ctx.register_prewarm()
+    with Connection('memory://') as conn:
+        reply(conn.default_channel).declare()
+        task_queue = ctx.broker.queues['startup']
+        task_queue(conn.default_channel).declare()
+        # 目标端口不可达，任务很快以连接失败回复，但仍会走完协议库导入与连接流程
+        Producer(conn.default_channel).publish(
+            {'id': 'startup', 'type': 'gather', 'encoding': 'utf-8',
+             'account': {'username': 'bench', 'password': 'bench'},
+             'conn': {'ip': '127.0.0.1', 'port': args.port or 1, 'proto': args.proto},
+             'task': {'cmd': 'true', 'mto': 5}}, exchange=task_queue.exchange, routing_key='startup',
+            reply_to='reply/startup-reply')
+    ready = time.perf_counter()
+    ctx.mq.run(thread=True, no_ack=False, prefetch_count=10)
+
+    with Connection('memory://') as conn:
+        queue = reply(conn.default_channel)
+        deadline = time.perf_counter() + 60
+        while time.perf_counter() < deadline:
+            message = queue.get(no_ack=True)
+            if message is not None:
+                marks['first_reply'] = time.perf_counter()
+                break
+            time.sleep(0.001)
+    ctx.mq.is_running = False
+    loaded = sorted(name for name in ('asyncssh', 'telnetlib3', 'asyncwinrm', 'httpx', 'numpy') if name in sys.modules)
+    print(json.dumps({
+        'import_core': round(imported - start, 4),
+        'ready': round(ready - T0, 4),
+        'first_consume': round(marks['first_consume'] - T0, 4) if 'first_consume' in marks else None,
+        'first_reply': round(marks['first_reply'] - T0, 4) if 'first_reply' in marks else None,
+        'loaded': loaded,
+    }))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup and time-to-first-consume benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--proto', choices=tuple(PORTS), default='ssh')
+    parser.add_argument('--port', type=int, default=1, help='target port of the probe task, closed by default')
+    parser.add_argument('--prewarm', nargs='*', default=[], help='protocols or modules to import at startup')
+    parser.add_argument('--sync-prewarm', action='store_true', help='prewarm before consuming instead of in background')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    cmd = [sys.executable, '-m', 'bench.startup', '--child', '--proto', args.proto, '--port', str(args.port)]
+    if args.prewarm:
+        cmd += ['--prewarm'] + args.prewarm
+    if args.sync_prewarm:
+        cmd.append('--sync-prewarm')
+    runs = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        out = subprocess.check_output(cmd, cwd=ROOT, stderr=subprocess.DEVNULL)
+        run = json.loads(out.decode().strip().splitlines()[-1])
+        run['process'] = round(time.perf_counter() - start, 4)
+        runs.append(run)
+
+    summary = {key: statistics.median(run[key] for run in runs if run[key] is not None)
+               for key in ('import_core', 'ready', 'first_consume', 'first_reply', 'process')
+               if any(run[key] is not None for run in runs)}
+    print(json.dumps({'repeat': args.repeat, 'proto': args.proto, 'prewarm': args.prewarm,
+                      'median_seconds': summary, 'loaded': runs[-1]['loaded']}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ from .context import Context
 from .dispatch import Dispatcher
 
 
-def create_ctx(config_path=None, config_env='DEVELOPMENT'):
+def create_ctx(config_path=None, config_env='DEVELOPMENT', workers=None, shard=None, stats=None, replay=None):
     if not (config_path and os.access(config_path, os.F_OK)):
         for path in DEFAULT_CONFIG_PATH:
             if os.access(path, os.F_OK):
@@ -37,7 +37,27 @@ def create_ctx(config_path=None, config_env='DEVELOPMENT'):
     ctx.logger.info('Operating environment: {}'.format(config_env))
     ctx.logger.info('Using config path: {}'.format(config_path))
 
-    ctx.register_mq(Dispatcher.handle_msg)
+    if workers and workers > 1:
+        ctx.register_supervisor(workers)
+        ctx.register_publisher()
+        ctx.register_metrics()
+        return ctx
+
+    if replay:
+        ctx.register_coroutine()
+        ctx.register_pool()
+        ctx.register_prewarm()
+        ctx.register_replay(Dispatcher.handle_msg, **replay)
+        ctx.register_metrics()
+        return ctx
+
+    ctx.register_mq(Dispatcher.handle_msg, async_callback=Dispatcher.dispatch)
+    ctx.register_publisher()
     ctx.register_coroutine()
+    ctx.register_pool()
+    ctx.register_prewarm()
+    if shard is not None:
+        ctx.register_shard(shard, stats)
+    ctx.register_metrics()
 
     return ctx
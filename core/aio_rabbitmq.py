@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+
+import aio_pika
+
+from utils import serialize_utils
+from . import metrics
+from .rabbitmq import requeue_on_failure
+
+logger = logging.getLogger(__name__)
+
+
+class AioMessage:
+    # 包装aio-pika消息，提供与kombu Message一致的属性，任务类无需区分消费方式
+    __slots__ = ('message', 'body', 'headers', 'properties', 'delivery_info', 'content_type', 'content_encoding')
+
+    def __init__(self, message):
+        self.message = message
+        self.body = message.body
+        self.headers = message.headers or {}
+        self.content_type = message.content_type
+        self.content_encoding = message.content_encoding
+        self.properties = {k: v for k, v in (('reply_to', message.reply_to),
+                                             ('correlation_id', message.correlation_id),
+                                             ('content_type', message.content_type),
+                                             ('content_encoding', message.content_encoding),
+                                             ('message_id', message.message_id)) if v}
+        self.delivery_info = {'delivery_tag': message.delivery_tag, 'redelivered': message.redelivered,
+                              'exchange': message.exchange, 'routing_key': message.routing_key}
+
+    def ack(self):
+        return asyncio.ensure_future(self.message.ack())
+
+    def reject(self, requeue=False):
+        return asyncio.ensure_future(self.message.reject(requeue=requeue))
+
+
+class AioRabbitMQ:
+    qos_interval = 0.2
+
+    def __init__(self, broker, cb=None):
+        self.broker = broker
+        self.cb = cb if cb else self.handle_message
+        self.is_running = False
+        self.no_ack = True
+        self.unacked = 0
+        self.loop = None
+        self.connection = None
+        self.channel = None
+        self._exchanges = {}
+        self._closed = None
+
+    @staticmethod
+    def handle_message(body, message):
+        logger.info(f'Received message: {body!r}')
+        message.ack()
+
+    async def run(self, queues=None, no_ack=True, prefetch_count=0, prefetch_limit=None, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        self.no_ack = no_ack
+        self._closed = self.loop.create_future()
+        self.connection = await aio_pika.connect_robust(self.broker.amqp)
+        self.channel = await self.connection.channel()
+        if prefetch_count and not no_ack:
+            await self.channel.set_qos(prefetch_count=prefetch_count)
+            if prefetch_limit:
+                self.loop.create_task(self._sync_qos(prefetch_count, prefetch_limit))
+
+        if not queues:
+            queues = list(self.broker.queues)
+        elif isinstance(queues, str):
+            queues = [queues]
+        for name in queues:
+            if name not in self.broker.queues:
+                logger.error('Not queue named {}'.format(name))
+                continue
+            queue = await self.declare(self.broker.queues[name])
+            await queue.consume(self._on_message, no_ack=no_ack)
+
+        self.is_running = True
+        logger.debug("Rabbitmq(asyncio) is running at {}".format(self.broker.host))
+        try:
+            await self._closed
+        finally:
+            self.is_running = False
+            await self.connection.close()
+
+    async def declare(self, kombu_queue):
+        exchange = kombu_queue.exchange
+        queue = await self.channel.declare_queue(kombu_queue.name, durable=kombu_queue.durable,
+                                                 exclusive=kombu_queue.exclusive,
+                                                 auto_delete=kombu_queue.auto_delete,
+                                                 arguments=kombu_queue.queue_arguments)
+        if exchange is not None and exchange.name:
+            aio_exchange = await self.channel.declare_exchange(exchange.name, type=exchange.type or 'direct',
+                                                               durable=exchange.durable,
+                                                               auto_delete=exchange.auto_delete)
+            self._exchanges[exchange.name] = aio_exchange
+            await queue.bind(aio_exchange, routing_key=kombu_queue.routing_key)
+        return queue
+
+    async def _sync_qos(self, prefetch, prefetch_limit):
+        # prefetch_limit(unacked)按协程调度器的状态给出broker可推送的上限
+        while not self._closed.done():
+            await asyncio.sleep(self.qos_interval)
+            target = prefetch_limit(self.unacked)
+            if target != prefetch:
+                try:
+                    await self.channel.set_qos(prefetch_count=target)
+                    prefetch = target
+                except Exception as e:
+                    logger.warning('Failed to update qos: {}'.format(e))
+
+    def ack(self, message):
+        self._settle(message, None)
+
+    def reject(self, message, requeue=False):
+        self._settle(message, requeue)
+
+    def _settle(self, message, requeue):
+        if message is None or self.no_ack:
+            return
+        self.loop.call_soon_threadsafe(self._do_settle, message, requeue)
+
+    def _do_settle(self, message, requeue):
+        self.unacked -= 1
+        if requeue is None:
+            message.ack()
+        else:
+            message.reject(requeue=requeue)
+
+    def stop(self):
+        if self._closed and not self._closed.done():
+            self.loop.call_soon_threadsafe(self._closed.set_result, None)
+
+    async def _on_message(self, message):
+        metrics.MESSAGES.inc()
+        if not self.no_ack:
+            self.unacked += 1
+        try:
+            self.cb(message.body, AioMessage(message))
+        except Exception as e:
+            logger.error('Cb has some problem {}'.format(e), exc_info=True)
+
+    async def _get_exchange(self, name):
+        if not name:
+            return self.channel.default_exchange
+        if name not in self._exchanges:
+            self._exchanges[name] = await self.channel.get_exchange(name, ensure=False)
+        return self._exchanges[name]
+
+    async def publish(self, data, exchange='', routing_key='', headers=None, content_type=None,
+                      content_encoding=None, message=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            await self._publish(data, exchange, routing_key, headers, content_type, content_encoding,
+                                serialize_utils.reply_format(message, self.broker.serializer))
+        except Exception:
+            metrics.PUBLISH_FAILURES.inc()
+            if message is not None and not self.no_ack:
+                self._do_settle(message, requeue_on_failure(message))
+            raise
+        metrics.PUBLISH_SECONDS.observe(time.perf_counter() - start)
+        if message is not None and not self.no_ack:
+            self._do_settle(message, None)
+
+    async def _publish(self, data, exchange, routing_key, headers, content_type, content_encoding, fmt=None):
+        if isinstance(data, (bytes, bytearray)):
+            body = bytes(data)
+        elif isinstance(data, str):
+            body = data.encode('utf-8')
+            content_type = content_type or 'application/json'
+            content_encoding = content_encoding or 'utf-8'
+        else:
+            body, content_type, content_encoding = serialize_utils.dumps(data, fmt or serialize_utils.JSON)
+        await (await self._get_exchange(exchange)).publish(
+            aio_pika.Message(body, headers=headers, content_type=content_type, content_encoding=content_encoding),
+            routing_key=routing_key)
+
+    def send_as_task(self, data, block=False, **kwargs):
+        # 在协程线程内直接调度发布，其他线程通过线程安全方式提交到协程循环
+        coro = self.publish(data, **kwargs)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            task = self.loop.create_task(coro)
+            task.add_done_callback(self._log_publish_error)
+            return task
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_publish_error)
+        return future
+
+    @staticmethod
+    def _log_publish_error(future):
+        if not future.cancelled() and future.exception():
+            logger.error('Failed to publish message: {}'.format(future.exception()))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import time
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def backoff_delay(attempt, base=0.5, cap=8):
+    # 指数退避加全抖动：第attempt次重试前等待[0, min(cap, base * 2^attempt)]中的随机时长
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitOpen(Exception):
+    def __init__(self, target, retry_after):
+        super().__init__('Circuit open for {}:{}, retry after {:.1f}s'.format(target[0], target[1], retry_after))
+        self.target = target
+        self.retry_after = retry_after
+
+
+class Circuit:
+    __slots__ = ('state', 'failures', 'opens', 'until', 'probing')
+
+    def __init__(self):
+        self.state = CLOSED
+        # failures: 连续失败次数；opens: 连续断开次数，决定退避时长
+        self.failures = 0
+        self.opens = 0
+        self.until = 0
+        self.probing = False
+
+
+class CircuitBreaker:
+    # 按目标(ip, 端口)统计连续的连接失败：达到threshold后断开(open)，退避期内的任务直接失败；
+    # 退避到期后半开(half_open)，只放行一个探测连接，成功则恢复(closed)，失败则加倍退避
+    def __init__(self, threshold=3, backoff=5, max_backoff=300, jitter=0.2, max_targets=100000):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_targets = max_targets
+        # 只记录有失败的目标，恢复后移除
+        self._circuits = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._circuits)
+
+    def state(self, target):
+        circuit = self._circuits.get(target)
+        return circuit.state if circuit else CLOSED
+
+    def check(self, target):
+        # 不改变状态的检查，供任务在排队前快速失败
+        with self._lock:
+            circuit = self._circuits.get(target)
+            if circuit is not None:
+                self._raise_if_blocked(target, circuit, time.monotonic())
+
+    def acquire(self, target):
+        # 建立新连接前调用：断开期内抛出CircuitOpen，退避到期后只放行一个探测连接
+        with self._lock:
+            circuit = self._circuits.get(target)
+            if circuit is None:
+                return
+            now = time.monotonic()
+            self._raise_if_blocked(target, circuit, now)
+            if circuit.state == OPEN:
+                circuit.state = HALF_OPEN
+            if circuit.state == HALF_OPEN:
+                circuit.probing = True
+
+    @staticmethod
+    def _raise_if_blocked(target, circuit, now):
+        if circuit.state == OPEN and now < circuit.until:
+            raise CircuitOpen(target, circuit.until - now)
+        if circuit.state == HALF_OPEN and circuit.probing:
+            raise CircuitOpen(target, 0)
+
+    def success(self, target):
+        with self._lock:
+            circuit = self._circuits.pop(target, None)
+        if circuit is not None and circuit.state != CLOSED:
+            logger.info('Circuit closed for {}:{}'.format(*target))
+
+    def failure(self, target):
+        with self._lock:
+            circuit = self._circuits.get(target)
+            if circuit is None:
+                circuit = self._circuits[target] = Circuit()
+                while len(self._circuits) > self.max_targets:
+                    self._circuits.popitem(last=False)
+            self._circuits.move_to_end(target)
+            circuit.failures += 1
+            circuit.probing = False
+            if circuit.state != HALF_OPEN and circuit.failures < self.threshold:
+                return
+            circuit.opens += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (circuit.opens - 1))
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+            circuit.state = OPEN
+            circuit.until = time.monotonic() + delay
+        logger.info('Circuit open for {}:{} after {} failures, retry in {:.1f}s'.format(
+            target[0], target[1], circuit.failures, delay))
+
+    def abort(self, target):
+        # 探测连接被取消，没有结果，允许下一个任务继续探测
+        with self._lock:
+            circuit = self._circuits.get(target)
+            if circuit is not None:
+                circuit.probing = False
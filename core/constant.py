@@ -15,3 +15,9 @@ DEFAULT_FIELD_STYLES = {
 }
 
 MAX_WORKER = 5
+
+# 多命令任务默认同时执行的命令数
+TASK_CONCURRENCY = 4
+
+# 流式输出时每个分片的最大字节数
+STREAM_CHUNK_SIZE = 64 * 1024
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import sys
 
 from utils.file_utils import read_yaml
+from .enums import MQMode
 
 
 class Context:
@@ -16,25 +18,147 @@ class Context:
                 Context.CONF = read_yaml(config_path, config_env)
 
         self.env = config_env
+        self.config_path = config_path
         self.logger = None
         self.broker = None
         self.mq = None
         self.mq_is_running = False
         self.coroutine = None
+        self.ssh_pool = None
+        self.telnet_pool = None
+        self.winrm_pool = None
+        self.encodings = None
+        self.targets = None
+        self.results = None
+        self.breaker = None
+        self.supervisor = None
+        self.shard = None
+        self.metrics = None
+        self.replay = None
 
-    def register_mq(self, callback):
+    def register_mq(self, callback, async_callback=None):
         from core import rabbitmq
         self.broker = rabbitmq.Broker()
         assert 'MQ_CONFIG' in self.CONF
         self.broker.load(config_dict=self.CONF['MQ_CONFIG'])
-        self.mq = rabbitmq.RabbitMQ(self.broker, cb=callback)
+        if self.mq_mode == MQMode.ASYNCIO:
+            # 消费者运行在协程循环上，消息解码与任务调度不再经过线程切换
+            from core import aio_rabbitmq
+            self.mq = aio_rabbitmq.AioRabbitMQ(self.broker, cb=async_callback or callback)
+        else:
+            self.mq = rabbitmq.RabbitMQ(self.broker, cb=callback)
+
+    def register_replay(self, callback, source, output, concurrency=None):
+        # 离线回放模式：任务来自JSONL文件，结果写入JSONL文件，不连接broker
+        from core import replay
+        self.mq = self.replay = replay.ReplayMQ(source, output, concurrency=concurrency or self.coroutine.capacity,
+                                                cb=callback)
+
+    def register_supervisor(self, workers=None):
+        # 多进程模式下主进程只负责按目标主机分片转发，任务在worker进程中执行
+        from core import rabbitmq, supervisor
+        attr = dict(self.CONF['SUPERVISOR_CONFIG']) if 'SUPERVISOR_CONFIG' in self.CONF else {}
+        attr['workers'] = workers or attr.get('workers')
+        self.supervisor = supervisor.Supervisor(self, **attr)
+        self.broker = rabbitmq.Broker()
+        self.broker.load(config_dict=self.CONF['MQ_CONFIG'])
+        self.mq = rabbitmq.RabbitMQ(self.broker, cb=self.supervisor.route)
+
+    def register_shard(self, shard, stats=None):
+        from core import supervisor
+        self.shard = shard
+        self.broker.use_shard(shard)
+        if stats is not None:
+            attr = self.CONF['SUPERVISOR_CONFIG'] if 'SUPERVISOR_CONFIG' in self.CONF else {}
+            reporter = supervisor.StatsReporter(shard, stats, interval=attr.get('heartbeat', 5))
+            self.coroutine.add_task(reporter.run(), name='stats-reporter')
+
+    def register_metrics(self):
+        # 本地Prometheus文本格式的指标端点，多进程模式下各worker使用port+shard+1
+        attr = dict(self.CONF['METRICS_CONFIG']) if 'METRICS_CONFIG' in self.CONF else {}
+        if not attr.pop('enable', True):
+            return
+        from core import metrics
+        lag_interval = attr.pop('lag_interval', 1)
+        if self.shard is not None:
+            attr['port'] = attr.get('port', 9464) + self.shard + 1
+        try:
+            self.metrics = metrics.MetricsServer(**attr)
+        except OSError as e:
+            self.logger.warning('Metrics endpoint disabled: {}'.format(e))
+            return
+        self.metrics.start()
+        if self.coroutine:
+            metrics.register_coro(self.coroutine)
+            self.coroutine.add_task(metrics.measure_loop_lag(lag_interval), name='loop-lag')
+
+    def register_publisher(self):
+        attr = dict(self.CONF['PUBLISHER_CONFIG']) if 'PUBLISHER_CONFIG' in self.CONF else {}
+        # asyncio模式下在协程循环上直接带confirm发布，不需要单独的发布线程
+        if not attr.pop('enable', True) or self.mq_mode == MQMode.ASYNCIO:
+            return
+        from core import publisher
+        self.mq.publisher = publisher.Publisher(self.broker, self.mq, **attr)
+        self.mq.publisher.start()
 
     def register_coroutine(self):
         from core import coro
-        attr = self.CONF['COROUTINE_CONFIG'] if 'COROUTINE_CONFIG' in self.CONF else {}
+        attr = dict(self.CONF['COROUTINE_CONFIG']) if 'COROUTINE_CONFIG' in self.CONF else {}
+        if 'SCHEDULER_CONFIG' in self.CONF:
+            attr['scheduler'] = self.CONF['SCHEDULER_CONFIG']
         self.coroutine = coro.Coro(daemon=True, **attr)
         self.coroutine.start()
 
+    def register_pool(self):
+        from moudle import pool
+        attr = self.CONF['SSH_POOL_CONFIG'] if 'SSH_POOL_CONFIG' in self.CONF else {}
+        self.ssh_pool = pool.SSHPool(**attr)
+        attr = self.CONF['TELNET_POOL_CONFIG'] if 'TELNET_POOL_CONFIG' in self.CONF else {}
+        self.telnet_pool = pool.TelnetPool(**attr)
+        attr = self.CONF['WINRM_POOL_CONFIG'] if 'WINRM_POOL_CONFIG' in self.CONF else {}
+        self.winrm_pool = pool.WinRMPool(**attr)
+        # 不可达目标的断路器，默认开启
+        attr = dict(self.CONF['BREAKER_CONFIG']) if 'BREAKER_CONFIG' in self.CONF else {}
+        if attr.pop('enable', True):
+            from core.breaker import CircuitBreaker
+            self.breaker = CircuitBreaker(**attr)
+        # 新建连接受全局令牌桶限速，复用池中的连接不受限制
+        for conn_pool in (self.ssh_pool, self.telnet_pool, self.winrm_pool):
+            conn_pool.rate_limiter = self.coroutine.scheduler.bucket if self.coroutine else None
+            conn_pool.breaker = self.breaker
+        # 按主机学习到的输出编码
+        from utils.crypto_utils import EncodingCache
+        attr = self.CONF['ENCODING_CONFIG'] if 'ENCODING_CONFIG' in self.CONF else {}
+        self.encodings = EncodingCache(**attr)
+        # 允许/禁止访问的网段，启动时构建一次
+        attr = self.CONF['TARGET_CONFIG'] if 'TARGET_CONFIG' in self.CONF else {}
+        if attr.get('allow') or attr.get('deny'):
+            from utils.ip_utils import TargetPolicy
+            self.targets = TargetPolicy(allow=attr.get('allow'), deny=attr.get('deny'))
+        # 幂等命令的结果缓存，任务指定max_age时才使用
+        attr = dict(self.CONF['RESULT_CACHE_CONFIG']) if 'RESULT_CACHE_CONFIG' in self.CONF else {}
+        if attr.pop('enable', False):
+            from core.result_cache import ResultCache
+            self.results = ResultCache(**attr)
+
+    def register_prewarm(self):
+        # 协议库默认在任务第一次用到时导入，prewarm中列出的协议或模块在启动时提前导入
+        attr = self.CONF['STARTUP_CONFIG'] if 'STARTUP_CONFIG' in self.CONF else {}
+        names = attr.get('prewarm') or []
+        if not names:
+            return
+        from threading import Thread
+        from utils.lazy_utils import prewarm
+        # 默认在后台线程导入，不推迟开始消费的时间
+        if attr.get('background', True):
+            Thread(target=prewarm, args=(names,), name='prewarm', daemon=True).start()
+        else:
+            prewarm(names)
+
+    @property
+    def coro(self):
+        return self.coroutine
+
     @property
     def version(self):
         return self.CONF["VERSION"]
@@ -43,12 +167,32 @@ class Context:
     def mq_config(self):
         return self.CONF['MQ_CONFIG']
 
+    @property
+    def mq_mode(self):
+        return self.CONF['MQ_CONFIG'].get('mode') or MQMode.KOMBU
+
     def run(self):
         try:
             self.mq_is_running = True
             self.logger.info('Starting mq service')
-            self.mq.run(thread=False, tag_prefix=self.mq_config['tag'] if 'tag' in self.mq_config else 'Know-arm',
-                        no_ack=True)
+            if self.replay:
+                return self.replay.run()
+            if self.supervisor:
+                no_ack = self.mq_config.get('no_ack', False)
+                return self.supervisor.run(tag_prefix=self.mq_config.get('tag') or 'Know-arm', no_ack=no_ack,
+                                           prefetch_count=0 if no_ack else self.mq_config.get('prefetch_count') or 100)
+            # 默认手动ack，回复发出后才确认；预取数量跟随协程调度器的空闲槽位
+            no_ack = self.mq_config.get('no_ack', False)
+            prefetch_count = 0 if no_ack else self.mq_config.get('prefetch_count') or self.coroutine.capacity
+            prefetch_limit = None if 'prefetch_count' in self.mq_config else self.coroutine.scheduler.prefetch
+            if self.mq_mode == MQMode.ASYNCIO:
+                asyncio.run_coroutine_threadsafe(
+                    self.mq.run(no_ack=no_ack, prefetch_count=prefetch_count, prefetch_limit=prefetch_limit),
+                    self.coroutine.loop).result()
+            else:
+                self.mq.run(thread=False,
+                            tag_prefix=self.mq_config['tag'] if 'tag' in self.mq_config else 'Know-arm',
+                            no_ack=no_ack, prefetch_count=prefetch_count, prefetch_limit=prefetch_limit)
         except KeyboardInterrupt:
             self.logger.info('Stopping Know-arm run and exiting...')
             sys.exit()
@@ -3,22 +3,32 @@
 import sys
 import time
 import asyncio
+import itertools
 import logging
+from collections import deque
 from threading import Thread
 
+from .scheduler import Scheduler
+
 logger = logging.getLogger(__name__)
 
 
 # TODO 需要增加异常输出  Coroutine
 
 class Coro(Thread):
-    def __init__(self, name='coroutine', sem=40, daemon=False):
+    def __init__(self, name='coroutine', sem=40, daemon=False, scheduler=None, history=1000):
         super().__init__(name=name, daemon=daemon)
         self.loop = asyncio.new_event_loop()
         self.tasks = {}
         # self.loop.set_exception_handler(self.custom_exception_handler)
-        self._sem_count = sem
-        self.sem = None
+        self.scheduler = Scheduler(capacity=sem, **(scheduler or {}))
+        self.done = 0
+        # 已结束任务立即移出tasks，只在环形缓冲区中保留最近的摘要
+        self.history = deque(maxlen=history)
+        self._counter = itertools.count(1)
+        # 任务id/批次id -> 运行中的协程task，用于按id、前缀或批次取消
+        self.keys = {}
+        self.batches = {}
 
     def __getitem__(self, item):
         try:
@@ -29,8 +39,8 @@ class Coro(Thread):
 
     def __repr__(self):
         d = {}
-        for name in self.tasks:
-            d[name] = {'state': self[name]._state}
+        for name, task in list(self.tasks.items()):
+            d[name] = {'state': task._state if task else 'PENDING'}
         return str(d)
 
     def run(self) -> None:
@@ -45,35 +55,132 @@ class Coro(Thread):
             self.loop.run_until_complete(self.loop.shutdown_asyncgens())
             self.loop.close()
 
-    async def sem_task(self, coro):
-        # 对task增加信号量，限制同一时间正在执行的任务数
-        if not self.sem:
-            self.sem = asyncio.Semaphore(self._sem_count)
-        async with self.sem:
+    @property
+    def capacity(self):
+        return self.scheduler.capacity
+
+    @property
+    def free_slots(self):
+        return self.scheduler.free
+
+    async def sem_task(self, coro, host=None, on_cancel=None):
+        # 按全局、主机、网段的并发上限排队，拿到槽位后才开始执行
+        try:
+            await self.scheduler.acquire(host)
+        except asyncio.CancelledError:
+            # 排队中被取消时任务协程不会执行，由on_cancel回复取消结果
+            coro.close()
+            if on_cancel:
+                on_cancel()
+            raise
+        try:
             return await coro
+        finally:
+            self.scheduler.release(host)
 
-    def add_task(self, coro, name=None, sem=False):
+    def add_task(self, coro, name=None, sem=False, host=None, key=None, batch=None, on_cancel=None):
         if name in self.tasks:
             return False
+        name = name or 'coro-{}'.format(next(self._counter))
+        # 先占住名字，task在协程循环中创建；其他线程提交时不直接操作循环
+        self.tasks[name] = None
+        args = (coro, name, sem, host, key, batch, on_cancel)
+        if self._in_loop():
+            self._create_task(*args)
+        else:
+            self.loop.call_soon_threadsafe(self._create_task, *args)
+        return name
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _create_task(self, coro, name, sem, host, key, batch, on_cancel):
         if sem:
-            task = self.loop.create_task(self.sem_task(coro))
+            task = self.loop.create_task(self.sem_task(coro, host, on_cancel), name=name)
         else:
             task = self.loop.create_task(coro, name=name)
-        self.loop._csock.send(b'\0')
-        name = task.get_name()
         self.tasks[name] = task
-        return name
+        task.add_done_callback(self._on_done)
+        if key is not None:
+            self._track(self.keys, key, task)
+        if batch is not None:
+            self._track(self.batches, batch, task)
+        return task
+
+    @staticmethod
+    def _track(index, key, task):
+        index.setdefault(key, set()).add(task)
+
+        def untrack(_):
+            tasks = index.get(key)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del index[key]
+
+        task.add_done_callback(untrack)
+
+    def _on_done(self, task):
+        self.done += 1
+        name = task.get_name()
+        if self.tasks.get(name) is task:
+            del self.tasks[name]
+        if task.cancelled():
+            state, error = 'cancelled', None
+        else:
+            error = task.exception()
+            state = 'error' if error else 'done'
+        self.history.append({'name': name, 'state': state, 'error': str(error) if error else None,
+                             'end_time': time.time()})
+
+    def recent(self, limit=None):
+        items = list(self.history)
+        return items[-limit:] if limit else items
+
+    def cancel(self, task_ids=(), prefix=None, batch_id=None):
+        # 可在任意线程调用，取消在协程循环上执行，不阻塞调用方
+        self.loop.call_soon_threadsafe(self._cancel, tuple(task_ids or ()), prefix, batch_id)
+
+    def _cancel(self, task_ids=(), prefix=None, batch_id=None):
+        tasks = set()
+        for key in task_ids:
+            tasks.update(self.keys.get(key, ()))
+        if prefix:
+            for key in list(self.keys):
+                if str(key).startswith(prefix):
+                    tasks.update(self.keys[key])
+        if batch_id is not None:
+            tasks.update(self.batches.get(batch_id, ()))
+        for task in tasks:
+            task.cancel()
+        logger.info('Cancel {} tasks, ids: {} prefix: {} batch: {}'.format(len(tasks), task_ids, prefix, batch_id))
+        return len(tasks)
 
     def status(self, name):
-        return self[name]._state
+        if name in self.tasks:
+            task = self.tasks[name]
+            return task._state if task else 'PENDING'
+        for item in reversed(self.history):
+            if item['name'] == name:
+                return item['state'].upper()
+        raise KeyError(name)
+
+    def stop_task(self, name):
+        self.loop.call_soon_threadsafe(self._stop_task, name)
 
-    def stop_task(self, name, nowait=False):
-        self[name].cancel()
-        if not nowait:
-            while not self.tasks[name].cancelled():
-                time.sleep(0.5)
+    def _stop_task(self, name):
+        task = self.tasks.get(name)
+        if task:
+            task.cancel()
 
     def get_result(self, name):
+        if name not in self.tasks:
+            for item in reversed(self.history):
+                if item['name'] == name:
+                    return item['error'] or 'Task {}'.format(item['state'])
         try:
             res = self[name].result()
             del self.tasks[name]
@@ -85,4 +192,6 @@ class Coro(Thread):
         return res
 
     def is_done(self, name):
-        return self[name].done()
+        # 已结束的任务会被移出tasks
+        task = self.tasks.get(name)
+        return name not in self.tasks or (task is not None and task.done())
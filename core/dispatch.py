@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import json
 import logging
 from concurrent.futures import ThreadPoolExecutor
-from moudle.gather import Task
+from moudle.gather import Task, FanoutTask
+from utils import serialize_utils
 from .enums import TaskType
 from .constant import MAX_WORKER
+from . import metrics
+from .context import Context
 from .model import InfoTask
 
 logger = logging.getLogger(__name__)
@@ -24,7 +26,20 @@ class Dispatcher:
 
     @classmethod
     def _handle_msg_in_thread(cls, body, message):
-        body = cls.decode_body(body)
+        cls.dispatch(body, message)
+
+    @classmethod
+    def dispatch(cls, body, message):
+        try:
+            cls._dispatch(body, message)
+        except Exception as e:
+            logger.error('Failed to handle message: {}'.format(e), exc_info=True)
+            Context.CTX.mq.reject(message, requeue=False)
+
+    @classmethod
+    def _dispatch(cls, body, message):
+        body = cls.decode_body(body, content_type=getattr(message, 'content_type', None))
+        metrics.TASKS.inc(type=body['type'], proto=(body.get('conn') or {}).get('proto') or '')
 
         logger.debug('Receiving task: {}'.format(body))
         logger.debug("Msg hdr:%s", message.headers)
@@ -41,19 +56,28 @@ class Dispatcher:
                 task.run()
             else:
                 logger.warning('Check failed with message {}'.format(body))
-                pass
+        elif body['type'] == TaskType.FANOUT:
+            task = FanoutTask(body, message)
+            if task.check():
+                task.run()
+            else:
+                logger.warning('Check failed with message {}'.format(body))
+        elif body['type'] == TaskType.STOP:
+            cls.stop_task(task_ids=body.get('task_ids'), prefix=body.get('prefix'), batch_id=body.get('batch_id'))
+            Context.CTX.mq.ack(message)
         elif body['type'] == TaskType.UNKNOWN:
             logger.warning("Unknown type")
-            pass
+            Context.CTX.mq.ack(message)
         else:
             logger.warning("This type is not supported: %s", body['type'])
-            pass
+            Context.CTX.mq.ack(message)
 
     @staticmethod
-    def decode_body(body):
+    def decode_body(body, content_type=None):
+        # 原始消息体按消息声明的content-type解析
         try:
             if not isinstance(body, dict):
-                body = json.loads(body)
+                body = serialize_utils.loads(body, content_type)
             if 'type' not in body:
                 body['type'] = 'UNKNOWN'
         except Exception as e:
@@ -63,5 +87,11 @@ class Dispatcher:
         return body
 
     @classmethod
-    def stop_task(cls, task_id):
-        pass
+    def stop_task(cls, task_ids=None, prefix=None, batch_id=None):
+        # 控制消息：按任务id、id前缀或批次id取消正在排队或执行的任务，被取消的任务回复MANUAL_CANCELLED
+        if isinstance(task_ids, str):
+            task_ids = [task_ids]
+        if not (task_ids or prefix or batch_id is not None):
+            logger.warning('Stop message without task_ids, prefix or batch_id')
+            return
+        Context.CTX.coro.cancel(task_ids=task_ids, prefix=prefix, batch_id=batch_id)
@@ -5,12 +5,19 @@ class Env:
     PROD = "PRODUCTION"
 
 
+class MQMode:
+    KOMBU = 'kombu'
+    ASYNCIO = 'asyncio'
+
+
 class TaskType:
     INFO = 'info'
     DETECT = 'detect'
     GATHER = 'gather'
+    FANOUT = 'fanout'
     SCAN = 'scan'
     SITE = 'site'
+    STOP = 'stop'
     UNKNOWN = 'unknown'
 
 
@@ -28,6 +35,8 @@ class ShellReplyCode:
     HIT_EOF_TIME_OUT = -4
     ERROR_DECODING = -5
     AUTHENTICATED_FAILED = -6
+    TARGET_DENIED = -7
+    CIRCUIT_OPEN = -8
     UNKNOWN_ERROR = -999
 
 
@@ -39,4 +48,6 @@ class ShellReplyMessage:
     HIT_EOF_TIME_OUT = 'hit eof time out'
     ERROR_DECODING = 'error decoding'
     AUTHENTICATED_FAILED = 'authenticated failed'
+    TARGET_DENIED = 'target denied'
+    CIRCUIT_OPEN = 'circuit open'
     UNKNOWN_ERROR = 'unknown error'
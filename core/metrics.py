@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import bisect
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), value) for key, value in items]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        # func: 采集时回调取值，返回数值或{标签值元组: 数值}
+        super().__init__(name, doc, labels)
+        self.values = {}
+        self.func = func
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.func:
+            try:
+                value = self.func()
+            except Exception as e:
+                logger.debug('Gauge {} failed: {}'.format(self.name, e))
+                return []
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), value) for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # 各桶计数 + 总和 + 总数
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        lines = []
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labels, key, [('le', bound)]), total))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), counts[-2]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), counts[-1]))
+        return lines
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+REGISTRY = []
+
+MESSAGES = Counter('know_arm_messages_consumed_total', 'Messages consumed from the task queues')
+TASKS = Counter('know_arm_tasks_total', 'Tasks dispatched by type and protocol', ('type', 'proto'))
+REPLIES = Counter('know_arm_replies_total', 'Task replies by protocol and reply code', ('proto', 'code'))
+CONNECT_SECONDS = Histogram('know_arm_connect_seconds', 'Connection setup time', ('proto',))
+COMMAND_SECONDS = Histogram('know_arm_command_seconds', 'Command execution time', ('proto',))
+PUBLISH_SECONDS = Histogram('know_arm_publish_seconds', 'Reply publish time until confirmed')
+PUBLISH_FAILURES = Counter('know_arm_publish_failures_total', 'Replies that failed to publish')
+CIRCUIT_OPEN = Counter('know_arm_circuit_open_total', 'Tasks failed fast because the target circuit is open',
+                       ('proto',))
+RESULT_CACHE = Counter('know_arm_result_cache_total', 'Result cache lookups by outcome', ('result',))
+LOOP_LAG = Gauge('know_arm_event_loop_lag_seconds', 'Delay of a timer on the coroutine loop')
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def register_coro(coro):
+    Gauge('know_arm_coro_running', 'Tasks holding a scheduler slot', func=lambda: coro.scheduler.running)
+    Gauge('know_arm_coro_capacity', 'Scheduler slot capacity', func=lambda: coro.scheduler.capacity)
+    Gauge('know_arm_coro_waiting', 'Tasks waiting for a scheduler slot', func=lambda: coro.scheduler.waiting)
+    Gauge('know_arm_coro_tasks', 'Tasks in the coroutine task table', func=lambda: len(coro.tasks))
+
+
+async def measure_loop_lag(interval=1):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(max(0, loop.time() - start - interval))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer(Thread):
+    def __init__(self, host='127.0.0.1', port=9464, name='metrics', daemon=True):
+        super().__init__(name=name, daemon=daemon)
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+
+    def run(self):
+        logger.info('Metrics endpoint listening on {}:{}'.format(*self.server.server_address))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
@@ -5,7 +5,7 @@ from moudle.info import GetEngineInfo
 
 
 class Task:
-    __slots__ = ('id', 'type', 'args', 'extra', 'exec_cls', 'reply', 'exchange', 'routing_key', 'result')
+    __slots__ = ('id', 'type', 'args', 'extra', 'exec_cls', 'reply', 'exchange', 'routing_key', 'result', 'message')
 
     def __init__(self, body, message):
         self.id = body['id'] if 'id' in body else None
@@ -13,6 +13,7 @@ class Task:
         self.args = body['args'] if 'id' in body else None
         self.extra = body['extra'] if 'id' in body else None
         self.exec_cls = None
+        self.message = message
         self.reply = "reply_to" in message.properties
         self.exchange = message.properties["reply_to"].split('/')[0] if self.reply else None
         self.routing_key = message.properties["reply_to"].split('/')[1] if self.reply else None
@@ -59,5 +60,8 @@ class Result:
         assert self.id, "Not id"
         assert self.type, "Not type"
 
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
     def __str__(self):
         return "Result[id:%s type:%s]" % (self.id, self.type)
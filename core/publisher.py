@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import socket
+import time
+from collections import OrderedDict
+from threading import Thread
+
+from kombu import Producer
+
+from . import metrics
+from .rabbitmq import requeue_on_failure
+
+logger = logging.getLogger(__name__)
+
+
+class PublishItem:
+    __slots__ = ('data', 'message', 'kwargs', 'retries', 'created')
+
+    def __init__(self, data, message=None, **kwargs):
+        self.data = data
+        self.message = message
+        self.kwargs = kwargs
+        self.retries = 0
+        self.created = time.monotonic()
+
+
+class Publisher(Thread):
+    # 结果发布线程：长连接+独立channel，按数量或等待时间攒批发布，异步等待publisher confirm后再确认任务消息
+    def __init__(self, broker, mq, batch_size=100, linger=0.01, confirm_timeout=5, max_queue=100000,
+                 max_retries=3, name='publisher', daemon=True):
+        super().__init__(name=name, daemon=daemon)
+        self.broker = broker
+        self.mq = mq
+        self.batch_size = batch_size
+        self.linger = linger
+        self.confirm_timeout = confirm_timeout
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.is_running = False
+        self._retry = []
+        self._pending = OrderedDict()
+        self._tag = 0
+        self._confirm = False
+
+    def put(self, data, message=None, **kwargs):
+        # 由CmdBase.reply等在协程线程中调用，不阻塞事件循环，队列满时抛出queue.Full
+        self.queue.put_nowait(PublishItem(data, message, **kwargs))
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            try:
+                with self.broker.new_connection() as connection:
+                    channel = connection.channel()
+                    self._setup_confirm(channel)
+                    producer = Producer(channel)
+                    logger.debug('Publisher is running, confirm: {}'.format(self._confirm))
+                    while self.is_running:
+                        batch = self._take_batch()
+                        if batch:
+                            self._publish(producer, batch)
+                            self._wait_confirms(connection)
+            except Exception as e:
+                logger.error('Publisher connection failed: {}'.format(e), exc_info=True)
+                self._requeue_pending()
+                time.sleep(1)
+
+    def _setup_confirm(self, channel):
+        self._tag = 0
+        self._pending.clear()
+        self._confirm = hasattr(channel, 'confirm_select')
+        if self._confirm:
+            channel.confirm_select()
+            channel.events['basic_ack'].add(self._on_ack)
+            channel.events['basic_nack'].add(self._on_nack)
+
+    def _take_batch(self):
+        batch, self._retry = self._retry[:self.batch_size], self._retry[self.batch_size:]
+        if not batch:
+            try:
+                batch.append(self.queue.get(timeout=0.5))
+            except queue.Empty:
+                return batch
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _publish(self, producer, batch):
+        for i, item in enumerate(batch):
+            try:
+                producer.publish(item.data, **item.kwargs)
+            except Exception:
+                self._retry = batch[i:] + self._retry
+                raise
+            if self._confirm:
+                self._tag += 1
+                self._pending[self._tag] = item
+            else:
+                self._done(item)
+
+    def _wait_confirms(self, connection):
+        deadline = time.monotonic() + self.confirm_timeout
+        while self._pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning('Publisher confirm timeout, {} messages pending'.format(len(self._pending)))
+                self._requeue_pending()
+                return
+            try:
+                connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                pass
+
+    def _confirmed(self, tag, multiple):
+        if multiple:
+            items = []
+            while self._pending and next(iter(self._pending)) <= tag:
+                items.append(self._pending.popitem(last=False)[1])
+            return items
+        item = self._pending.pop(tag, None)
+        return [item] if item else []
+
+    def _on_ack(self, tag, multiple):
+        for item in self._confirmed(tag, multiple):
+            self._done(item)
+
+    def _on_nack(self, tag, multiple):
+        for item in self._confirmed(tag, multiple):
+            self._failed(item, 'nacked by broker')
+
+    def _done(self, item):
+        metrics.PUBLISH_SECONDS.observe(time.monotonic() - item.created)
+        self.mq.ack(item.message)
+
+    def _failed(self, item, reason):
+        item.retries += 1
+        if item.retries <= self.max_retries:
+            self._retry.append(item)
+        else:
+            logger.error('Failed to publish result after {} retries: {}'.format(self.max_retries, reason))
+            metrics.PUBLISH_FAILURES.inc()
+            if item.message is not None:
+                self.mq.reject(item.message, requeue=requeue_on_failure(item.message))
+
+    def _requeue_pending(self):
+        items = list(self._pending.values())
+        self._pending.clear()
+        for item in items:
+            self._failed(item, 'confirm lost')
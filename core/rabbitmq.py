@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import socket
+import time
+from collections import deque
 from pprint import pformat
-from threading import Thread
+from queue import Full
+from threading import Thread, current_thread
 
 from amqp.exceptions import ConnectionForced
-from kombu import Connection, Consumer, Exchange, Queue, eventloop
+from kombu import Connection, Consumer, Exchange, Queue
 from kombu.pools import producers
 
+from utils import serialize_utils
 from utils.dict_utils import find_attr
 from utils.file_utils import read_yaml
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +24,11 @@ def pretty(obj):
     return pformat(obj, indent=4)
 
 
+def requeue_on_failure(message):
+    # 回复发送失败时重新入队一次，重复投递的消息不再重新入队，避免死循环
+    return not message.delivery_info.get('redelivered')
+
+
 class Broker:
     queue_attrs = ['queue_arguments', 'binding_arguments', 'consumer_arguments', 'durable', 'exclusive', 'auto_delete',
                    'no_ack', 'alias', 'bindings', 'no_declare', 'expires', 'message_ttl', 'max_length',
@@ -40,6 +51,10 @@ class Broker:
             _queue_attr = find_attr(self.queue_attrs, self.kwargs)
             self.add_conn(queue, routing_key, exchange_type, exchange, _queue_attr, _exchange_attr)
 
+        self.shard_prefix = None
+        self.control_queue = None
+        # 回复的默认序列化格式(json/msgpack)，任务消息声明了content-type时回复使用相同格式
+        self.serializer = serialize_utils.JSON
         self._conn = None
 
     def load(self, config_dict=None, config_path=None, enforce=True):
@@ -57,6 +72,8 @@ class Broker:
 
         exchanges = config.pop('exchange') if 'exchange' in config else {}
         queues = config.pop('queue') if 'queue' in config else {}
+        # 控制消息(stop)使用单独的队列，任务队列积压时也能及时消费
+        control = config.pop('control') if 'control' in config else None
 
         if enforce:
             self.__dict__.update(config)
@@ -67,6 +84,9 @@ class Broker:
             self.add_exchange(**exchange)
         for queue in queues:
             self.add_queue(**queue)
+        if control:
+            self.add_queue(**control)
+            self.control_queue = control['name']
 
     def _check(self):
         if not self.host:
@@ -92,6 +112,10 @@ class Broker:
             self._conn = Connection(self.amqp, **self.kwargs)
         return self._conn
 
+    def new_connection(self):
+        self._check()
+        return Connection(self.amqp, **self.kwargs)
+
     def add_exchange(self, **kwarg):
         _name = kwarg['name']
         _exchange = Exchange(**kwarg)
@@ -106,6 +130,30 @@ class Broker:
         else:
             logger.error('Not exist {} this exchange'.format(kwarg['exchange']))
 
+    def shard_name(self, shard):
+        return '{}.shard{}'.format(self._shard_prefix(), shard)
+
+    def _shard_prefix(self):
+        # 未配置shard_prefix时以第一个任务队列名为前缀
+        return self.shard_prefix or next((name for name in self.queues if name != self.control_queue), 'know-arm')
+
+    def shard_queue(self, shard):
+        # 分片队列通过默认exchange按队列名投递，与原队列的exchange类型无关
+        name = self.shard_name(shard)
+        return Queue(name, routing_key=name, durable=True, auto_delete=False)
+
+    def declare_shards(self, workers):
+        with self.new_connection() as connection:
+            channel = connection.channel()
+            for shard in range(workers):
+                self.shard_queue(shard)(channel).declare()
+
+    def use_shard(self, shard):
+        # worker进程只消费自己的分片队列
+        queue = self.shard_queue(shard)
+        self.shard_prefix = self._shard_prefix()
+        self.queues = {queue.name: queue}
+
     def add_conn(self, queue, routing_key, exchange_type, exchange, queue_attrs=None, exchange_attrs=None):
         if exchange_attrs is None:
             exchange_attrs = {}
@@ -116,11 +164,20 @@ class Broker:
 
 
 class RabbitMQ:
+    qos_interval = 0.2
+
     def __init__(self, broker, cb=None):
         self.broker = broker
         self.cb = cb if cb else self.handle_message
         self.is_running = False
         self.thread = None
+        self.publisher = None
+        self.no_ack = True
+        self.unacked = 0
+        self._consumer_thread = None
+        self._settles = deque()
+        self._prefetch = 0
+        self._qos_time = 0
 
     def run(self, queues=None, thread=True, **kwargs):
         res = []
@@ -155,17 +212,35 @@ class RabbitMQ:
         logger.info(f' delivery_info:\n{pretty(message.delivery_info)}')
         message.ack()
 
-    def _run_consumer(self, queues, **kwargs):
-        timeout = kwargs.get('timeout') or 1
-        ignore_timeouts = kwargs.get('ignore_timeouts') or True
+    def _on_message(self, body, message):
+        metrics.MESSAGES.inc()
+        if not self.no_ack:
+            self.unacked += 1
+        self.cb(body, message)
+
+    def _on_raw_message(self, message):
+        # 跳过kombu的反序列化，消息体由回调按content-type解析
+        self._on_message(message.body, message)
+
+    def _run_consumer(self, queues, prefetch_limit=None, **kwargs):
+        self.no_ack = kwargs.get('no_ack', True)
+        # 手动ack时由其他线程提交的ack需要尽快在消费线程中发出
+        timeout = kwargs.pop('timeout', None) or (1 if self.no_ack else 0.1)
+        self._consumer_thread = current_thread()
         with self.broker.connection() as connection:
-            with Consumer(connection, queues, callbacks=[self.cb], **kwargs):
+            with Consumer(connection, queues, on_message=self._on_raw_message, **kwargs) as consumer:
+                self._prefetch = kwargs.get('prefetch_count') or 0
                 self.is_running = True
                 logger.debug("Rabbitmq is running at {}".format(self.broker.amqp))
                 while self.is_running:
                     try:
-                        for _ in eventloop(connection, timeout=timeout, ignore_timeouts=ignore_timeouts):
+                        try:
+                            connection.drain_events(timeout=timeout)
+                        except socket.timeout:
                             pass
+                        self._flush_settles()
+                        if prefetch_limit and not self.no_ack:
+                            self._sync_qos(consumer, prefetch_limit)
                     except ConnectionForced as e:
                         self.is_running = False
                         logger.info('MQ received a force close commend: {}'.format(e))
@@ -177,6 +252,67 @@ class RabbitMQ:
                         logger.error('Cb has some problem {}'.format(e), exc_info=True)
                         break
 
-    def send_as_task(self, data, block=False, **kwargs):
-        with producers[self.broker.connection()].acquire(block=block) as producer:
-            producer.publish(data, **kwargs)
+    def _sync_qos(self, consumer, prefetch_limit):
+        # prefetch_limit(unacked)按协程调度器的状态给出broker可推送的上限
+        now = time.monotonic()
+        if now - self._qos_time < self.qos_interval:
+            return
+        self._qos_time = now
+        prefetch = prefetch_limit(self.unacked)
+        if prefetch != self._prefetch:
+            consumer.qos(prefetch_count=prefetch)
+            self._prefetch = prefetch
+
+    def ack(self, message):
+        self._settle(message, None)
+
+    def reject(self, message, requeue=False):
+        self._settle(message, requeue)
+
+    def _settle(self, message, requeue):
+        # py-amqp的channel不是线程安全的，非消费线程的ack交给消费线程发出
+        if message is None or self.no_ack:
+            return
+        if current_thread() is self._consumer_thread:
+            self._do_settle(message, requeue)
+        else:
+            self._settles.append((message, requeue))
+
+    def _do_settle(self, message, requeue):
+        self.unacked -= 1
+        try:
+            if requeue is None:
+                message.ack()
+            else:
+                message.reject(requeue=requeue)
+        except Exception as e:
+            logger.error('Failed to settle message {}: {}'.format(message.delivery_tag, e))
+
+    def _flush_settles(self):
+        while self._settles:
+            self._do_settle(*self._settles.popleft())
+
+    def send_as_task(self, data, block=False, message=None, **kwargs):
+        # message: 回复发布成功后需要确认的原始任务消息
+        if not isinstance(data, (bytes, bytearray, str)):
+            data, kwargs['content_type'], kwargs['content_encoding'] = serialize_utils.dumps(
+                data, serialize_utils.reply_format(message, self.broker.serializer))
+        if self.publisher:
+            try:
+                self.publisher.put(data, message=message, **kwargs)
+            except Full:
+                if message is not None:
+                    self.reject(message, requeue=True)
+                raise
+            return
+        start = time.perf_counter()
+        try:
+            with producers[self.broker.connection()].acquire(block=block) as producer:
+                producer.publish(data, **kwargs)
+        except Exception:
+            metrics.PUBLISH_FAILURES.inc()
+            if message is not None:
+                self.reject(message, requeue=requeue_on_failure(message))
+            raise
+        metrics.PUBLISH_SECONDS.observe(time.perf_counter() - start)
+        self.ack(message)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import sys
+import time
+from threading import BoundedSemaphore, Lock, Thread
+
+from utils import serialize_utils
+from utils.compress_utils import unpack_result
+from utils.crypto_utils import bytes2base64
+
+logger = logging.getLogger(__name__)
+
+REPLAY_REPLY_TO = 'replay/results'
+
+
+class ReplayMessage:
+    # 与kombu Message一致的属性，任务类无需区分消息来源
+    __slots__ = ('body', 'line', 'headers', 'properties', 'delivery_info', 'content_type', 'content_encoding')
+
+    def __init__(self, body, line):
+        self.body = body
+        self.line = line
+        self.headers = {}
+        self.properties = {'reply_to': REPLAY_REPLY_TO}
+        self.delivery_info = {'delivery_tag': line, 'redelivered': False}
+        self.content_type = 'application/json'
+        self.content_encoding = 'utf-8'
+
+    def ack(self):
+        pass
+
+    def reject(self, requeue=False):
+        pass
+
+
+class ReplayMQ:
+    # 离线回放：从JSONL文件逐行读取任务，经Dispatcher执行，结果逐行写入输出JSONL文件，不需要broker
+    def __init__(self, source, output, concurrency=40, cb=None):
+        self.source = source
+        self.output = output
+        self.cb = cb
+        self.publisher = None
+        self.no_ack = False
+        self.is_running = False
+        self.unacked = 0
+        self.total = 0
+        self.written = 0
+        self._slots = BoundedSemaphore(concurrency)
+        self._lock = Lock()
+        self._queue = queue.Queue(maxsize=10000)
+        self._writer = None
+
+    def run(self, **kwargs):
+        self.is_running = True
+        self._writer = Thread(target=self._write_loop, name='replay-writer', daemon=True)
+        self._writer.start()
+        start = time.time()
+        source = sys.stdin if self.source == '-' else open(self.source, encoding='utf-8')
+        try:
+            for line, text in enumerate(source, 1):
+                if not self.is_running:
+                    break
+                text = text.strip()
+                if not text:
+                    continue
+                try:
+                    body = serialize_utils.loads(text)
+                except ValueError as e:
+                    logger.warning('Skip invalid json at line {}: {}'.format(line, e))
+                    self._queue.put({'line': line, 'code': -999, 'err_info': 'invalid json: {}'.format(e)})
+                    continue
+                # 在途任务数达到并发上限时等待，消息确认(回复写出)后释放
+                self._slots.acquire()
+                with self._lock:
+                    self.unacked += 1
+                    self.total += 1
+                self.cb(body, ReplayMessage(body, line))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        while self.unacked > 0 and self.is_running:
+            time.sleep(0.05)
+        self._queue.put(None)
+        self._writer.join()
+        logger.info('Replay finished, {} tasks, {} records written to {} in {:.1f}s'.format(
+            self.total, self.written, self.output, time.time() - start))
+
+    def _write_loop(self):
+        with open(self.output, 'a', encoding='utf-8') as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(serialize_utils.dumps(record)[0].decode('utf-8') + '\n')
+                self.written += 1
+                if self._queue.empty():
+                    f.flush()
+
+    def ack(self, message):
+        self._settle(message)
+
+    def reject(self, message, requeue=False):
+        self._settle(message)
+
+    def _settle(self, message):
+        if message is None:
+            return
+        with self._lock:
+            self.unacked -= 1
+        self._slots.release()
+
+    def send_as_task(self, data, block=False, message=None, **kwargs):
+        if isinstance(data, (bytes, bytearray)):
+            # 压缩发布的结果还原后写出，原始输出按base64记录
+            data = unpack_result(data, kwargs.get('headers') or {}, kwargs.get('content_encoding'))
+            for item in [data] + list(data.get('results') or ()):
+                for field in ('stdout', 'stderr'):
+                    if isinstance(item.get(field), bytes):
+                        item[field] = bytes2base64(item[field])
+        self._queue.put(data)
+        self.ack(message)
+
+    def stop(self):
+        self.is_running = False
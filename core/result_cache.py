@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# 缓存的结果字段，id、时间与耗时等每次回复各自生成
+RESULT_FIELDS = ('cmd', 'encoding', 'stdout', 'stderr', 'returncode', 'code', 'err_info')
+
+
+def result_key(connect_info, cmd, encoding):
+    # 主机、端口、协议、账号(密码取摘要)、命令与编码相同的任务才共用结果
+    account = connect_info.account
+    digest = hashlib.sha1(str(account.password).encode()).hexdigest()
+    return (connect_info.ip, connect_info.port, connect_info.proto, account.username, digest,
+            tuple(cmd) if isinstance(cmd, (list, tuple)) else cmd, encoding or '')
+
+
+def copy_result(res):
+    data = {field: res.get(field) for field in RESULT_FIELDS}
+    if res.get('results') is not None:
+        data['results'] = [{field: item.get(field) for field in RESULT_FIELDS if field in item}
+                           for item in res['results']]
+    return data
+
+
+def result_size(res):
+    size = 0
+    for item in [res] + list(res.get('results') or ()):
+        size += len(item.get('stdout') or '') + len(item.get('stderr') or '')
+    return size
+
+
+class ResultCache:
+    # 幂等的采集命令(uname -a、systeminfo等)结果按max_age复用，按条数与输出总大小做LRU淘汰
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, max_age=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # 任务指定的max_age不超过该上限
+        self.max_age = max_age
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, max_age):
+        # 返回(结果副本, 缓存时间)，不存在或超过max_age时返回None
+        max_age = min(max_age, self.max_age)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            data, stored, size = item
+            age = time.time() - stored
+            if age > self.max_age:
+                del self._items[key]
+                self.size -= size
+                return None
+            if age > max_age:
+                return None
+            self._items.move_to_end(key)
+        return copy_result(data), stored
+
+    def put(self, key, res):
+        data = copy_result(res)
+        size = result_size(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._items[key] = (data, time.time(), size)
+            self.size += size
+            while self._items and (len(self._items) > self.max_entries or self.size > self.max_bytes):
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import ipaddress
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=65536)
+def subnet_of(host, prefix=24):
+    try:
+        return str(ipaddress.ip_network('{}/{}'.format(host, prefix), strict=False))
+    except ValueError:
+        return host
+
+
+class TokenBucket:
+    # 令牌桶：限制全局新建连接的速率，允许burst个连接的突发
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        # 令牌可以透支，等待者按到达顺序依次睡到各自令牌补足的时刻
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class SlotContext:
+    __slots__ = ('scheduler', 'host')
+
+    def __init__(self, scheduler, host):
+        self.scheduler = scheduler
+        self.host = host
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.host)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self.host)
+
+
+class Scheduler:
+    # 协程循环上的任务调度：全局并发数、单主机与单网段并发上限，等待中的任务按主机轮转唤醒，
+    # 一个主机积压大量任务时不会饿死其他主机
+    def __init__(self, capacity=40, per_host=4, per_subnet=0, subnet_prefix=24, rate=0, burst=None):
+        self.capacity = capacity
+        self.per_host = per_host
+        self.per_subnet = per_subnet
+        self.subnet_prefix = subnet_prefix
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.running = 0
+        self._hosts = Counter()
+        self._subnets = Counter()
+        self._waiters = OrderedDict()
+
+    @property
+    def free(self):
+        return max(0, self.capacity - self.running)
+
+    @property
+    def waiting(self):
+        # 消费线程中也会读取，先复制再遍历
+        return sum(len(waiters) for waiters in list(self._waiters.values()))
+
+    def prefetch(self, unacked):
+        # 消费端的预取上限：未确认消息中除去在调度器中等待的(即执行中与等待回复确认的) + 空闲槽位，不超过capacity；
+        # 因单主机/网段上限而等待的消息不再放大预取数量，积压留在broker中
+        return max(1, min(self.capacity, self.free + max(0, unacked - self.waiting)))
+
+    def slot(self, host=None):
+        return SlotContext(self, host)
+
+    def _subnet(self, host):
+        return subnet_of(host, self.subnet_prefix) if host and self.per_subnet else None
+
+    def _can_run(self, host):
+        if self.running >= self.capacity:
+            return False
+        if host and self.per_host and self._hosts[host] >= self.per_host:
+            return False
+        subnet = self._subnet(host)
+        if subnet and self._subnets[subnet] >= self.per_subnet:
+            return False
+        return True
+
+    def _take(self, host):
+        self.running += 1
+        if host:
+            self._hosts[host] += 1
+            subnet = self._subnet(host)
+            if subnet:
+                self._subnets[subnet] += 1
+
+    async def acquire(self, host=None):
+        if not self._waiters.get(host) and self._can_run(host):
+            self._take(host)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(host, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到槽位后才被取消，归还槽位
+                self.release(host)
+            else:
+                waiters = self._waiters.get(host)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiters[host]
+            raise
+
+    def release(self, host=None):
+        self.running -= 1
+        if host:
+            self._hosts[host] -= 1
+            if self._hosts[host] <= 0:
+                del self._hosts[host]
+            subnet = self._subnet(host)
+            if subnet:
+                self._subnets[subnet] -= 1
+                if self._subnets[subnet] <= 0:
+                    del self._subnets[subnet]
+        self._wake()
+
+    def _wake(self):
+        # 每轮每个主机最多唤醒一个等待者，被唤醒的主机移到队尾
+        woken = True
+        while woken and self.running < self.capacity:
+            woken = False
+            for host in list(self._waiters):
+                if not self._can_run(host):
+                    continue
+                waiters = self._waiters[host]
+                while waiters and waiters[0].done():
+                    waiters.popleft()
+                if waiters:
+                    self._take(host)
+                    waiters.popleft().set_result(None)
+                    woken = True
+                if waiters:
+                    self._waiters.move_to_end(host)
+                else:
+                    del self._waiters[host]
+                if self.running >= self.capacity:
+                    break
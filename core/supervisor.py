@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import zlib
+
+from .context import Context
+from .enums import TaskType
+
+logger = logging.getLogger(__name__)
+
+# 转发时不沿用的属性：投递信息由broker重新生成，消息体格式单独传递，user_id由broker按转发连接的用户校验
+SKIP_PROPERTIES = ('delivery_info', 'delivery_tag', 'body_encoding', 'content_type', 'content_encoding',
+                   'application_headers', 'user_id')
+
+
+def shard_key(body):
+    # 同一目标主机的任务总是落在同一个worker上，保证各进程内的连接池有效
+    conn = body.get('conn') or {}
+    return str(conn.get('ip') or body.get('id') or '')
+
+
+def shard_of(body, workers):
+    return zlib.crc32(shard_key(body).encode()) % workers
+
+
+def forward_properties(message):
+    # 原消息的持久化、优先级、过期时间、message_id等属性原样带到分片队列
+    properties = {key: value for key, value in message.properties.items()
+                  if key not in SKIP_PROPERTIES and value is not None}
+    if 'expiration' in properties:
+        # 收到的过期时间为毫秒字符串，kombu发布时按秒传入
+        properties['expiration'] = int(properties['expiration']) / 1000
+    return properties
+
+
+def run_worker(config_path, config_env, shard, stats):
+    # worker进程入口：独立的协程循环与连接池，只消费自己的分片队列
+    from core import create_ctx
+    ctx = create_ctx(config_path=config_path, config_env=config_env, shard=shard, stats=stats)
+    ctx.run()
+
+
+class WorkerState:
+    __slots__ = ('shard', 'process', 'started', 'last_seen', 'stats', 'restarts')
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.process = None
+        self.started = 0
+        self.last_seen = 0
+        self.stats = {}
+        self.restarts = 0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    # 多进程模式：主进程只按目标主机把任务转发到分片队列，并监控各worker的健康与吞吐
+    def __init__(self, ctx, workers=None, heartbeat=5, restart_delay=1):
+        self.ctx = ctx
+        self.workers = workers or os.cpu_count() or 1
+        self.heartbeat = heartbeat
+        self.restart_delay = restart_delay
+        self.mp = multiprocessing.get_context('spawn')
+        self.stats = self.mp.Queue()
+        self.states = [WorkerState(i) for i in range(self.workers)]
+        self.routed = 0
+        self.is_running = False
+
+    def route(self, body, message):
+        # 消费线程中调用：转发原始消息体及属性到分片队列，转发成功后确认原消息
+        try:
+            from .dispatch import Dispatcher
+            body = Dispatcher.decode_body(body, content_type=message.content_type)
+            # 控制消息广播给所有worker，任务消息按目标主机分片
+            shards = range(self.workers) if body['type'] == TaskType.STOP else [shard_of(body, self.workers)]
+            properties = forward_properties(message)
+            for shard in shards:
+                # 原始消息体连同content_type/content_encoding转发，kombu不会再次序列化
+                self.ctx.mq.send_as_task(message.body, message=message if shard == shards[-1] else None,
+                                         exchange='', routing_key=self.ctx.broker.shard_name(shard),
+                                         headers=message.headers,
+                                         content_type=message.content_type or 'application/data',
+                                         content_encoding=message.content_encoding or 'binary', **properties)
+            self.routed += 1
+        except Exception as e:
+            logger.error('Failed to route message: {}'.format(e), exc_info=True)
+
+    def start_worker(self, state):
+        state.process = self.mp.Process(target=run_worker, name='know-arm-worker-{}'.format(state.shard),
+                                        args=(self.ctx.config_path, self.ctx.env, state.shard, self.stats),
+                                        daemon=True)
+        state.process.start()
+        state.started = state.last_seen = time.monotonic()
+        logger.info('Worker {} started, pid {}'.format(state.shard, state.process.pid))
+
+    def run(self, **kwargs):
+        self.is_running = True
+        self.ctx.broker.declare_shards(self.workers)
+        for state in self.states:
+            self.start_worker(state)
+        self.ctx.mq.run(thread=True, **kwargs)
+        report = time.monotonic() + self.heartbeat
+        try:
+            while self.is_running:
+                self.collect(timeout=1)
+                self.check_workers()
+                if time.monotonic() >= report:
+                    self.report()
+                    report = time.monotonic() + self.heartbeat
+        finally:
+            self.stop()
+
+    def collect(self, timeout=1):
+        try:
+            stats = self.stats.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            shard = stats.get('shard')
+            if shard is not None and 0 <= shard < self.workers:
+                state = self.states[shard]
+                state.stats = stats
+                state.last_seen = time.monotonic()
+            try:
+                stats = self.stats.get_nowait()
+            except queue.Empty:
+                return
+
+    def check_workers(self):
+        now = time.monotonic()
+        for state in self.states:
+            if state.alive:
+                if now - state.last_seen > self.heartbeat * 3:
+                    logger.warning('Worker {} missed heartbeat for {:.0f}s'.format(state.shard, now - state.last_seen))
+                continue
+            if now - state.started < self.restart_delay:
+                continue
+            logger.error('Worker {} exited with code {}, restarting'.format(state.shard, state.process.exitcode))
+            state.restarts += 1
+            self.start_worker(state)
+
+    def report(self):
+        total = sum(state.stats.get('done', 0) for state in self.states)
+        logger.info('Supervisor routed {} tasks, workers done {} tasks'.format(self.routed, total))
+        for state in self.states:
+            logger.info('Worker {} pid {} alive {} restarts {} stats {}'.format(
+                state.shard, state.process.pid if state.process else None, state.alive, state.restarts, state.stats))
+
+    def health(self):
+        now = time.monotonic()
+        return [{'shard': state.shard, 'alive': state.alive, 'restarts': state.restarts,
+                 'last_seen': now - state.last_seen, **state.stats} for state in self.states]
+
+    def stop(self):
+        self.is_running = False
+        self.ctx.mq.is_running = False
+        for state in self.states:
+            if state.alive:
+                state.process.terminate()
+        for state in self.states:
+            if state.process:
+                state.process.join(timeout=5)
+
+
+class StatsReporter:
+    # worker进程内定时上报健康与吞吐，运行在协程循环上
+    def __init__(self, shard, stats, interval=5):
+        self.shard = shard
+        self.stats = stats
+        self.interval = interval
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.stats.put_nowait(self.snapshot())
+            except Exception as e:
+                logger.debug('Failed to report stats: {}'.format(e))
+
+    def snapshot(self):
+        ctx = Context.CTX
+        coro = ctx.coroutine
+        return {'shard': self.shard, 'pid': os.getpid(), 'time': time.time(), 'done': coro.done,
+                'running': coro.capacity - coro.free_slots, 'unacked': getattr(ctx.mq, 'unacked', 0),
+                'ssh_conns': len(ctx.ssh_pool) if ctx.ssh_pool else 0}
@@ -9,8 +9,14 @@ from core.banner import banner
 @click.command()
 @click.option("--env", default="PRODUCTION", type=str)
 @click.option("--config", required=False, type=str)
-def main(env, config):
-    ctx = create_ctx(config_path=config, config_env=env)
+@click.option("--workers", default=0, type=int, help="Number of worker processes, tasks are sharded by target host")
+@click.option("--replay", required=False, type=str, help="Run task bodies from a JSONL file ('-' for stdin) without a broker")
+@click.option("--output", default="results.jsonl", type=str, help="Result JSONL file for --replay")
+@click.option("--concurrency", default=0, type=int, help="Max in-flight tasks for --replay")
+def main(env, config, workers, replay, output, concurrency):
+    if replay:
+        replay = {'source': replay, 'output': output, 'concurrency': concurrency}
+    ctx = create_ctx(config_path=config, config_env=env, workers=workers, replay=replay)
     click.secho(banner % ctx.version, fg="blue")
     ctx.run()
 
@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import json
 import logging
 import time
 
 from core import Context
-from utils.json_utils import MsgEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -26,8 +24,10 @@ class Base:
     def reply(self):
         if self.task.reply:
             try:
-                Context.CTX.mq.send_as_task(json.dumps(self.task.result.__dict__), exchange=self.task.exchange,
-                                            routing_key=self.task.routing_key)
+                Context.CTX.mq.send_as_task(self.task.result.to_dict(), exchange=self.task.exchange,
+                                            routing_key=self.task.routing_key, message=self.task.message)
             except Exception as e:
                 logger.error('Failed to sent task {} result, reason {}'.format(self.task.id, e), exc_info=True)
+        else:
+            Context.CTX.mq.ack(self.task.message)
         logger.info('Task {} end!'.format(self.task.id))
@@ -2,54 +2,270 @@
 
 import asyncio
 import logging
-import re
+import random
 import time
 
-import asyncssh
-import httpx._exceptions as exceptions
-import telnetlib3
-from asyncssh import PermissionDenied, ConnectionLost
-from asyncwinrm import Session
-
-from utils.crypto_utils import bytes2base64, bytes_decode
+from utils.lazy_utils import lazy_import
+from utils.compress_utils import RESULT_CONTENT_TYPE, negotiate, pack_result, raw_size
+from utils.crypto_utils import StreamDecoder, bytes2base64, bytes_decode
+from core.constant import TASK_CONCURRENCY, STREAM_CHUNK_SIZE
+from core import metrics
+from core.breaker import CircuitOpen, backoff_delay
 from core.context import Context
+from core.result_cache import result_key
 from core.enums import ShellReplyCode as ReCode, ShellReplyMessage as ReMes
+from moudle.telnet import LoginError, ReadTimeout
 
 logger = logging.getLogger(__name__)
 
+# 协议库在任务第一次用到时才导入
+asyncssh = lazy_import('asyncssh')
+httpx = lazy_import('httpx')
+asyncwinrm = lazy_import('asyncwinrm')
+winrm_exceptions = lazy_import('asyncwinrm.exceptions')
+
 
 class CmdBase:
-    __slots__ = ('connect_info', 'cmd', 'reply_to', 'res', 'id', 'task', 'timeout', 'encoding', 'is_replied')
+    __slots__ = ('connect_info', 'cmd', 'reply_to', 'res', 'id', 'task', 'timeout', 'encoding', 'is_replied',
+                 'multi', 'concurrency', 'message', 'stream', 'seq', 'batch', 'timing', 'clock', 'codec',
+                 'cache_key', 'max_age')
 
-    def __init__(self, connect_info=None, reply_to=None, body=None):
+    def __init__(self, connect_info=None, reply_to=None, body=None, message=None):
         self.id = body.get('id')
         self.task = body.get('task')
         assert self.task, 'task data is empty'
         self.cmd = self.task.get('cmd')
         assert self.cmd, 'not exist cmd'
+        self.multi = isinstance(self.cmd, (list, tuple))
+        if self.multi:
+            assert all(cmd and isinstance(cmd, str) for cmd in self.cmd), 'invalid cmd list'
+        self.concurrency = max(1, int(self.task.get('concurrency') or TASK_CONCURRENCY))
         self.timeout = self.task.get('mto') or 100
         self.encoding = body.get('encoding') or False
         self.connect_info = connect_info
         self.reply_to = reply_to
-        self.res = {'id': self.id, 'cmd': str(self.cmd), 'encoding': self.encoding or '', 'stdout': '',
-                    'stderr': '', 'returncode': None, 'code': ReCode.SUCCESS, 'err_info': ''}
+        self.message = message
+        self.batch = body.get('batch_id')
+        # 未指定encoding时输出为原始字节，请求方声明可解压的算法时大结果以压缩字节发布，否则转base64
+        self.codec = None if self.encoding else negotiate(
+            (message.headers or {}).get('accept-encoding') if message is not None else None) or negotiate(
+            self.task.get('accept_encoding'))
+        self.res = {'id': self.id, 'cmd': list(self.cmd) if self.multi else str(self.cmd),
+                    'encoding': self.encoding or '', 'stdout': '', 'stderr': '', 'returncode': None,
+                    'code': ReCode.SUCCESS, 'err_info': ''}
+        if self.multi:
+            # 多命令任务每条命令的结果单独记录，顺序与cmd一致
+            self.res['results'] = [self.new_result(cmd) for cmd in self.cmd]
+        # 流式模式下输出按分片随到随发，最终结果只包含汇总信息
+        self.stream = bool(self.task.get('stream'))
+        self.seq = 0
+        if self.stream:
+            self.res['stream'] = True
+            self.res['chunks'] = 0
         self.is_replied = False
+        # 任务指定max_age(秒)时，可复用缓存中不超过该时长的相同命令结果
+        self.max_age = float(self.task.get('max_age') or 0)
+        self.cache_key = None
+        if self.max_age and not self.stream and Context.CTX.results is not None:
+            # 原始字节输出与文本输出分开缓存
+            self.cache_key = result_key(connect_info, self.cmd, self.encoding or ('raw' if self.codec else ''))
+        # 各阶段耗时(秒，单调时钟)，按TIMING_CONFIG.sample_rate抽样记录
+        self.clock = time.monotonic()
+        self.timing = {} if self.sampled() else None
+        if self.timing is not None:
+            self.res['timing'] = self.timing
+
+    @staticmethod
+    def new_result(cmd):
+        return {'cmd': cmd, 'stdout': '', 'stderr': '', 'returncode': None, 'code': ReCode.SUCCESS, 'err_info': ''}
+
+    @staticmethod
+    def sampled():
+        conf = (Context.CONF or {}).get('TIMING_CONFIG') or {}
+        rate = conf.get('sample_rate', 1)
+        return rate >= 1 or random.random() < rate
+
+    def phase(self, name, start, res=None):
+        # 记录从start到现在的耗时，res为多命令任务中单条命令的结果
+        if self.timing is None:
+            return
+        timing = self.timing if res is None or res is self.res else res.setdefault('timing', {})
+        timing[name] = round(time.monotonic() - start, 6)
+
+    def conn_phase(self, entry, start):
+        # 连接池中取连接的耗时；新建的连接附带tcp/kex/auth等阶段
+        if self.timing is None:
+            return
+        self.phase('connect', start)
+        if entry.uses <= 1:
+            self.timing.update(entry.phases or {})
+        else:
+            self.timing['reused'] = True
+
+    @property
+    def results(self):
+        return self.res['results'] if self.multi else [self.res]
+
+    async def exec_all(self, execute, concurrency=None):
+        # execute(res) 执行一条命令并把结果写入res
+        if not self.multi:
+            return await self.timed(execute, self.res)
+        sem = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def _exec(res):
+            async with sem:
+                await self.timed(execute, res)
+
+        tasks = [asyncio.ensure_future(_exec(res)) for res in self.results]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def timed(self, execute, res):
+        start = time.monotonic()
+        try:
+            with metrics.COMMAND_SECONDS.time(proto=self.connect_info.proto):
+                return await execute(res)
+        finally:
+            if self.timing is not None:
+                timing = self.timing if res is self.res else res.setdefault('timing', {})
+                # exec不含输出解码的耗时
+                timing['exec'] = round(time.monotonic() - start - timing.get('decode', 0), 6)
 
     def run(self):
         raise NotImplementedError(f'{self.__class__.__name__}.parse callback is not defined')
 
+    def submit(self):
+        if self.short_circuit():
+            return None
+        # 按任务id和批次id登记，收到stop控制消息时可取消
+        return Context.CTX.coro.add_task(self.async_task(), sem=True, host=self.connect_info.ip, key=self.id,
+                                         batch=self.batch, on_cancel=self.cancelled)
+
+    def short_circuit(self):
+        # 命中结果缓存或目标处于断路状态时直接回复，不再排队执行
+        return self.from_cache() or self.circuit_open()
+
+    def circuit_open(self):
+        breaker = Context.CTX.breaker
+        if breaker is None:
+            return False
+        try:
+            breaker.check((self.connect_info.ip, self.connect_info.port))
+        except CircuitOpen as e:
+            self.open_circuit(e)
+            self.reply()
+            return True
+        return False
+
+    def open_circuit(self, err):
+        metrics.CIRCUIT_OPEN.inc(proto=self.connect_info.proto)
+        self.res['code'] = ReCode.CIRCUIT_OPEN
+        self.res['err_info'] = str(err)
+
+    def from_cache(self):
+        # 命中结果缓存时直接回复，不占用调度槽位也不建立连接
+        if self.cache_key is None:
+            return False
+        hit = Context.CTX.results.get(self.cache_key, self.max_age)
+        metrics.RESULT_CACHE.inc(result='hit' if hit else 'miss')
+        if hit is None:
+            self.res['cache'] = {'hit': False}
+            return False
+        data, stored = hit
+        self.res.update(data)
+        self.res['cache'] = {'hit': True, 'age': round(time.time() - stored, 3), 'cached_at': stored}
+        self.res.setdefault('start_time', time.time())
+        self.reply()
+        return True
+
+    def cache_result(self):
+        # 只缓存全部命令都成功的结果
+        if self.cache_key is None or self.res['cache']['hit']:
+            return
+        if all(item['code'] == ReCode.SUCCESS for item in [self.res] + list(self.res.get('results') or ())):
+            Context.CTX.results.put(self.cache_key, self.res)
+
+    def cancelled(self):
+        self.res['code'] = ReCode.MANUAL_CANCELLED
+        self.res['err_info'] = ReMes.MANUAL_CANCELLED
+        self.reply()
+
+    def encoding_key(self, res=None):
+        # 编码缓存按主机记录，per_command时再区分命令
+        cache = Context.CTX.encodings
+        if cache is None:
+            return None, None
+        return cache, cache.key(self.connect_info.ip, (self.res if res is None else res)['cmd'])
+
+    def decode_text(self, data, res=None):
+        cache, key = self.encoding_key(res)
+        return bytes_decode(data, self.encoding, cache=cache, key=key)
+
+    def stream_decoder(self, res=None):
+        cache, key = self.encoding_key(res)
+        return StreamDecoder(self.encoding, cache=cache, key=key)
+
+    def send(self, data, message=None, **kwargs):
+        exchange = str(self.reply_to).split('/')[0]
+        routing_key = str(self.reply_to).split('/')[1]
+        Context.CTX.mq.send_as_task(data, exchange=exchange, routing_key=routing_key, message=message, **kwargs)
+
+    @staticmethod
+    def compress_threshold():
+        conf = (Context.CONF or {}).get('RESULT_CONFIG') or {}
+        return conf.get('compress_threshold', 64 * 1024)
+
+    def encode_output(self):
+        # 发布前的原始字节输出：达到阈值时压缩为消息体，否则沿用base64文本
+        if not self.codec:
+            return self.res, {}
+        if raw_size(self.res) >= self.compress_threshold():
+            body, headers = pack_result(self.res, self.codec)
+            return body, {'content_type': RESULT_CONTENT_TYPE, 'content_encoding': self.codec, 'headers': headers}
+        for item in [self.res] + list(self.res.get('results') or ()):
+            for field in ('stdout', 'stderr'):
+                if isinstance(item.get(field), bytes):
+                    item[field] = bytes2base64(item[field])
+        return self.res, {}
+
     def reply(self):
         if not self.is_replied:
             self.res['end_time'] = time.time()
-            exchange = str(self.reply_to).split('/')[0]
-            routing_key = str(self.reply_to).split('/')[1]
+            self.phase('total', self.clock)
+            if self.stream:
+                self.res['chunks'] = self.seq
             try:
                 self.log()
-                Context.CTX.mq.send_as_task(self.res, exchange=exchange, routing_key=routing_key)
+                metrics.REPLIES.inc(proto=self.connect_info.proto, code=self.res['code'])
+                self.cache_result()
+                data, kwargs = self.encode_output()
+                self.send(data, message=self.message, **kwargs)
                 self.is_replied = True
             except Exception as e:
                 logger.error('Failed to sent task {} result, reason {}'.format(self.id, e), exc_info=True)
 
+    def send_chunk(self, name, data, res=None):
+        # 分片按seq递增编号，stdout与stderr共用同一序列，接收方据此排序
+        if not data:
+            return
+        self.seq += 1
+        # 协议库已按文本返回的分片(如未指定编码的ssh)直接发送，只有原始字节需要转base64
+        if self.codec and isinstance(data, (bytes, bytearray)):
+            data = bytes2base64(data)
+        chunk = {'id': self.id, 'seq': self.seq, 'stream': name, 'data': data}
+        if self.multi and res is not None:
+            chunk['cmd'] = res['cmd']
+        if 'host' in self.res:
+            chunk['host'] = self.res['host']
+        try:
+            self.send(chunk)
+        except Exception as e:
+            logger.error('Failed to sent task {} chunk {}, reason {}'.format(self.id, self.seq, e))
+
     def log(self):
         if self.res['code'] >= 0:
             logger.info('Task {} Success!'.format(self.id))
@@ -67,23 +283,30 @@ class AsyncSSH(CmdBase):
 
     def run(self):
         self.res['start_time'] = time.time()
-        self.task = Context.CTX.coro.add_task(self.async_task())
+        self.task = self.submit()
 
     async def async_task(self):
+        pool = Context.CTX.ssh_pool
+        entry = None
+        discard = False
+        # 多命令时每条命令占用连接上的一个channel，并行数不超过单个连接的channel上限
+        weight = min(self.concurrency, len(self.cmd)) if self.multi else 1
+        weight = max(1, min(weight, pool.max_refs))
+        self.phase('queue', self.clock)
         try:
-            async with asyncssh.connect(
-                    host=self.connect_info.ip,
-                    port=self.connect_info.port,
-                    username=self.connect_info.account.username,
-                    password=self.connect_info.account.password,
-                    known_hosts=None) as conn:
-                if self.cmd:
-                    self.parse_output(await conn.run(self.cmd, timeout=self.timeout))
-                await conn.run('exit', timeout=self.timeout)
+            start = time.monotonic()
+            entry = await pool.acquire(self.connect_info, weight=weight)
+            self.conn_phase(entry, start)
+            if self.cmd:
+                await self.exec_all(lambda res: self.exec_cmd(entry.conn, res), concurrency=weight)
         except asyncio.exceptions.CancelledError:
+            # 取消时channel已随create_process的async with关闭，正在打开的channel无法确认，连接不再复用
+            discard = True
             self.res['code'] = ReCode.MANUAL_CANCELLED
             self.res['err_info'] = ReMes.MANUAL_CANCELLED
-        except PermissionDenied:
+        except CircuitOpen as e:
+            self.open_circuit(e)
+        except asyncssh.PermissionDenied:
             self.res['code'] = ReCode.PERMISSION_DENIED
             self.res['err_info'] = ReMes.PERMISSION_DENIED
         except asyncssh.process.TimeoutError:
@@ -92,7 +315,11 @@ class AsyncSSH(CmdBase):
         except TimeoutError:
             self.res['code'] = ReCode.CONNECTION_TIME_OUT
             self.res['err_info'] = ReMes.CONNECTION_TIME_OUT
-        except (ConnectionResetError, ConnectionLost):
+        except (ConnectionResetError, asyncssh.ConnectionLost):
+            discard = True
+            if entry:
+                await pool.release(entry, discard=discard, weight=weight)
+                entry = None
             if not await self.re_connecting():  # [Connect reset by peer] or [Connection lost]
                 self.res['code'] = ReCode.CONNECTION_TIME_OUT
                 self.res['err_info'] = ReMes.CONNECTION_TIME_OUT
@@ -104,25 +331,74 @@ class AsyncSSH(CmdBase):
             self.res['code'] = ReCode.UNKNOWN_ERROR
             self.res['err_info'] = str(e)
         finally:
+            if entry:
+                await pool.release(entry, discard=discard, weight=weight)
             self.reply()
 
     async def re_connecting(self, cnt=3):
+        # 重连间隔按指数退避并加随机抖动，目标断路后不再等待重试
         while self.conn_cnt <= cnt:
-            if not self.is_replied:
-                await asyncio.sleep(2)
-                self.conn_cnt += 1
-                await self.async_task()
-            else:
+            if self.is_replied or self.circuit_open():
                 break
+            await asyncio.sleep(backoff_delay(self.conn_cnt))
+            self.conn_cnt += 1
+            await self.async_task()
         return True if self.conn_cnt <= cnt else False
 
-    def parse_output(self, out):
-        self.res['stdout'] = out.stdout
-        self.res['stderr'] = out.stderr
-        self.res['returncode'] = out.returncode
-        if out.returncode < 0:
-            self.res['code'] = ReCode.UNKNOWN_ERROR
-            self.res['err_info'] = ReMes.UNKNOWN_ERROR
+    async def exec_cmd(self, conn, res):
+        try:
+            if self.stream:
+                await self.stream_cmd(conn, res)
+            else:
+                # 超时或取消时退出async with即关闭channel，远端命令随之结束，连接放回池中时不残留channel；
+                # 指定了编码时取原始字节，按主机缓存的编码解码
+                async with conn.create_process(res['cmd'], **self.run_kwargs()) as process:
+                    out = await process.wait(timeout=self.timeout)
+                self.parse_output(out, res)
+        except asyncssh.process.TimeoutError:
+            res['code'] = ReCode.HIT_EOF_TIME_OUT
+            res['err_info'] = ReMes.HIT_EOF_TIME_OUT
+        except UnicodeDecodeError as e:
+            res['code'] = ReCode.ERROR_DECODING
+            res['err_info'] = str(e)
+
+    def run_kwargs(self):
+        return {'encoding': None} if self.encoding else {}
+
+    async def stream_cmd(self, conn, res):
+        async with conn.create_process(res['cmd'], **self.run_kwargs()) as process:
+            async def pump(reader, name):
+                decoder = self.stream_decoder(res) if self.encoding else None
+                while True:
+                    data = await reader.read(STREAM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.send_chunk(name, decoder.decode(data) if decoder else data, res)
+                if decoder:
+                    self.send_chunk(name, decoder.flush(), res)
+
+            try:
+                await asyncio.wait_for(asyncio.gather(pump(process.stdout, 'stdout'), pump(process.stderr, 'stderr'),
+                                                      process.wait()), self.timeout)
+            except asyncio.TimeoutError:
+                res['code'] = ReCode.HIT_EOF_TIME_OUT
+                res['err_info'] = ReMes.HIT_EOF_TIME_OUT
+                return
+        res['returncode'] = process.returncode
+        if process.returncode is None or process.returncode < 0:
+            res['code'] = ReCode.UNKNOWN_ERROR
+            res['err_info'] = ReMes.UNKNOWN_ERROR
+
+    def parse_output(self, out, res=None):
+        res = self.res if res is None else res
+        start = time.monotonic()
+        res['stdout'] = self.decode_text(out.stdout, res) if isinstance(out.stdout, bytes) else out.stdout
+        res['stderr'] = self.decode_text(out.stderr, res) if isinstance(out.stderr, bytes) else out.stderr
+        self.phase('decode', start, res)
+        res['returncode'] = out.returncode
+        if out.returncode is None or out.returncode < 0:
+            res['code'] = ReCode.UNKNOWN_ERROR
+            res['err_info'] = ReMes.UNKNOWN_ERROR
 
 
 class AsyncWinRM(CmdBase):
@@ -132,7 +408,7 @@ class AsyncWinRM(CmdBase):
 
     def run(self):
         self.res['start_time'] = time.time()
-        self.task = Context.CTX.coro.add_task(self.async_task())
+        self.task = self.submit()
 
     @property
     def target(self):
@@ -142,28 +418,49 @@ class AsyncWinRM(CmdBase):
             return self.connect_info.ip
 
     async def async_task(self):
+        pool = Context.CTX.winrm_pool
+        entry = None
+        discard = False
+        # 多命令时每条命令占用会话上的一个shell，并行数不超过单个会话的shell上限
+        weight = min(self.concurrency, len(self.cmd)) if self.multi else 1
+        weight = max(1, min(weight, pool.max_refs))
+        self.phase('queue', self.clock)
         try:
-            s = Session(self.target, auth=(self.connect_info.account.username, self.connect_info.account.password))
+            start = time.monotonic()
+            entry = await pool.acquire(self.connect_info, weight=weight)
+            self.conn_phase(entry, start)
             if self.cmd:
-                response = await s.run_cmd(self.cmd, ['/all'])
-                self.parse_output(response)
+                await self.exec_all(lambda res: self.exec_cmd(entry.conn, res), concurrency=weight)
             else:
-                await s.run_cmd('echo test', ['/all'])
+                await self.run_command(entry.conn, 'echo test')
         except asyncio.exceptions.CancelledError:
+            discard = True
             self.res['code'] = ReCode.MANUAL_CANCELLED
-        except exceptions.HTTPStatusError as e:
+            self.res['err_info'] = ReMes.MANUAL_CANCELLED
+        except CircuitOpen as e:
+            self.open_circuit(e)
+        except httpx.HTTPStatusError as e:
+            discard = True
             if '401 Client Error' in str(e):
                 self.res['code'] = ReCode.PERMISSION_DENIED
             else:
                 logger.error(e, exc_info=True)
                 self.res['code'] = ReCode.UNKNOWN_ERROR
                 self.res['err_info'] = str(e)
-        except asyncssh.process.TimeoutError:
+        except httpx.ConnectTimeout:
+            discard = True
+            self.res['code'] = ReCode.CONNECTION_TIME_OUT
+            self.res['err_info'] = ReMes.CONNECTION_TIME_OUT
+        except (httpx.TimeoutException, winrm_exceptions.WinRMOperationTimeoutError):
+            # http请求超时后会话上的连接状态不确定，不再放回连接池
+            discard = True
             self.res['code'] = ReCode.HIT_EOF_TIME_OUT
+            self.res['err_info'] = ReMes.HIT_EOF_TIME_OUT
         except UnicodeDecodeError as e:
             self.res['code'] = ReCode.ERROR_DECODING
             self.res['err_info'] = str(e)
         except Exception as e:
+            discard = True
             if 'Connection lost' in str(e):
                 self.res['code'] = ReCode.CONNECTION_TIME_OUT
             else:
@@ -171,42 +468,119 @@ class AsyncWinRM(CmdBase):
                 self.res['code'] = ReCode.UNKNOWN_ERROR
                 self.res['err_info'] = str(e)
         finally:
+            if entry:
+                await pool.release(entry, discard=discard, weight=weight)
             self.reply()
 
-    def parse_output(self, out):
-        self.res['stdout'] = bytes_decode(out.std_out, self.encoding) if self.encoding else bytes2base64(out.std_out)
-        self.res['stderr'] = bytes_decode(out.std_err, self.encoding) if self.encoding else bytes2base64(out.std_err)
-        self.res['returncode'] = out.status_code
+    async def exec_cmd(self, client, res):
+        try:
+            response = await self.run_command(client, res['cmd'], res)
+        except asyncio.TimeoutError:
+            res['code'] = ReCode.HIT_EOF_TIME_OUT
+            res['err_info'] = ReMes.HIT_EOF_TIME_OUT
+            return
+        try:
+            self.parse_output(response, res)
+        except UnicodeDecodeError as e:
+            res['code'] = ReCode.ERROR_DECODING
+            res['err_info'] = str(e)
+
+    async def run_command(self, client, cmd, res=None):
+        # 复用会话上空闲的shell，命令正常结束后shell放回会话
+        protocol = client.protocol
+        start = time.monotonic()
+        shell_id = await client.open_shell()
+        if res is not None:
+            # 复用空闲shell时接近0，首次打开shell时包含http连接与认证
+            self.phase('shell', start, res)
+        reuse = False
+        try:
+            command_id = await protocol.run_command(shell_id, cmd, ['/all'])
+            if self.stream and res is not None:
+                response = asyncwinrm.Response(await self.stream_output(protocol, shell_id, command_id, res))
+            else:
+                response = asyncwinrm.Response(await protocol.get_command_output(shell_id, command_id))
+            await protocol.cleanup_command(shell_id, command_id)
+            reuse = True
+        finally:
+            await client.release_shell(shell_id, reuse=reuse)
+        return response
+
+    async def stream_output(self, protocol, shell_id, command_id, res):
+        # get_command_output在命令结束后才返回全部输出，逐次取分片只能用私有的_raw_get_command_output；
+        # 服务端的操作超时会被静默重试，整体按mto截止，超时抛出asyncio.TimeoutError，shell随后被关闭
+        command_done = False
+        return_code = -1
+        deadline = time.monotonic() + self.timeout
+        # 多字节字符可能跨分片，stdout与stderr各自增量解码
+        decoders = {'stdout': self.stream_decoder(res), 'stderr': self.stream_decoder(res)} if self.encoding else None
+        while not command_done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            try:
+                stdout, stderr, return_code, command_done = await asyncio.wait_for(
+                    protocol._raw_get_command_output(shell_id, command_id), remaining)
+            except winrm_exceptions.WinRMOperationTimeoutError:
+                continue
+            for name, data in (('stdout', stdout), ('stderr', stderr)):
+                self.send_chunk(name, decoders[name].decode(data) if decoders else self.decode(data), res)
+        if decoders:
+            for name, decoder in decoders.items():
+                self.send_chunk(name, decoder.flush(), res)
+        return b'', b'', return_code
+
+    def decode(self, data, res=None):
+        if not data:
+            return ''
+        if self.encoding:
+            return self.decode_text(data, res)
+        return data if self.codec else bytes2base64(data)
+
+    def parse_output(self, out, res=None):
+        res = self.res if res is None else res
+        start = time.monotonic()
+        res['stdout'] = self.decode(out.std_out, res)
+        res['stderr'] = self.decode(out.std_err, res)
+        self.phase('decode', start, res)
+        res['returncode'] = out.status_code
         if out.status_code < 0:
-            self.res['code'] = ReCode.UNKNOWN_ERROR
-            self.res['err_info'] = ReMes.UNKNOWN_ERROR
+            res['code'] = ReCode.UNKNOWN_ERROR
+            res['err_info'] = ReMes.UNKNOWN_ERROR
 
 
 class TelnetConn(CmdBase):
-    user_ps = b'login:'
-    pass_ps = b'Password:'
-    success_match = '(?i)(Last login:|Last failed login:)'
-    success_match_byte = b'(?i)(Last login:|Last failed login:)'
-
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        conf = Context.CONF.get('TELNET_CONFIG') or {} if Context.CONF else {}
+        prompts = ((kwargs.get('body') or {}).get('conn') or {}).get('prompt') or conf.get('prompts')
         self.task = None
-        self.writer = None
-        self.reader = None
-        self._start_text = None
-        self._is_connected = False
-        self._is_closed = False
+        self.session = None
+        self.entry = None
+        # 未配置时使用TelnetPool的默认值
+        self.idle_timeout = conf.get('idle_timeout')
+        self.login_timeout = conf.get('login_timeout')
+        self._prompts = prompts if isinstance(prompts, list) or prompts is None else [prompts]
+        self._discard = False
 
     def run(self):
         self.res['start_time'] = time.time()
-        self.task = Context.CTX.coro.add_task(self.async_task())
+        self.task = self.submit()
 
     async def async_task(self):
         try:
             await self.connect()
             if self.cmd:
-                self.parse_output(await self.parse_cmd(self.cmd))
+                # 同一telnet会话只能顺序执行命令
+                await self.exec_all(self.exec_cmd, concurrency=1)
+        except CircuitOpen as e:
+            self.open_circuit(e)
+        except ReadTimeout:
+            self._discard = True
+            self.res['code'] = ReCode.HIT_EOF_TIME_OUT
+            self.res['err_info'] = ReMes.HIT_EOF_TIME_OUT
         except OSError:
+            self._discard = True
             self.res['code'] = ReCode.CONNECTION_TIME_OUT
             self.res['err_info'] = ReMes.CONNECTION_TIME_OUT
         except LoginError:
@@ -215,67 +589,89 @@ class TelnetConn(CmdBase):
         except UnicodeDecodeError as e:
             self.res['code'] = ReCode.ERROR_DECODING
             self.res['err_info'] = str(e)
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            self.res['code'] = ReCode.UNKNOWN_ERROR
-            self.res['err_info'] = str(e)
+        except BaseException as e:
+            # 取消或未知异常时会话状态不确定，不再放回连接池
+            self._discard = True
+            if isinstance(e, asyncio.exceptions.CancelledError):
+                self.res['code'] = ReCode.MANUAL_CANCELLED
+                self.res['err_info'] = ReMes.MANUAL_CANCELLED
+            else:
+                logger.error(e, exc_info=True)
+                self.res['code'] = ReCode.UNKNOWN_ERROR
+                self.res['err_info'] = str(e)
         finally:
             self.reply()
             await self.close()
 
     async def close(self):
-        try:
-            if self._is_connected:
-                if not self._is_closed:
-                    self.writer.close()
-                    self._is_closed = True
-        except Exception:
-            pass
-
-    def parse_output(self, out):
-        if out.endswith(self._start_text):
-            out = out[:-len(self._start_text)]
-        self.res['stdout'] = out if self.encoding else bytes2base64(out)
-        self.res['code'] = ReCode.SUCCESS
+        if self.entry:
+            entry, self.entry = self.entry, None
+            try:
+                await Context.CTX.telnet_pool.release(entry, discard=self._discard or not self.session.synced)
+            except Exception:
+                pass
 
-    async def connect(self):
-        self.reader, self.writer = await telnetlib3.open_connection(
-            self.connect_info.ip, self.connect_info.port, encoding=self.encoding or 'utf8', connect_maxwait=5.0)
-        _ = await self.reader.readuntil(TelnetConn.user_ps)
-        await self.write(self.connect_info.account.username)
-        _ = await self.reader.readuntil(TelnetConn.pass_ps)
-        await self.write(self.connect_info.account.password)
-        login_res = await self.read_all()
-        if re.search(TelnetConn.success_match if self.encoding else TelnetConn.success_match_byte, login_res):
-            self._start_text = login_res.split('\r\n' if self.encoding else b'\r\n')[-1]
-            self._is_connected = True
+    async def exec_cmd(self, res):
+        if self.stream:
+            await self.stream_cmd(res)
         else:
-            raise LoginError
+            self.parse_output(await self.parse_cmd(res['cmd']), res)
+
+    async def stream_cmd(self, res):
+        # 总是暂存最新的一个分片，结束时去掉末尾的提示符后再发出
+        last = None
+
+        def on_data(data):
+            nonlocal last
+            if not data:
+                return
+            if last:
+                self.send_chunk('stdout', self.format_output(last), res)
+            last = data
+
+        await self.write(res['cmd'])
+        await self.read_until_prompt(on_data=on_data)
+        if last:
+            self.send_chunk('stdout', self.format_output(self.strip_prompt(last)), res)
+        res['code'] = ReCode.SUCCESS
+
+    def strip_prompt(self, out):
+        if out.endswith(self.session.start_text):
+            out = out[:-len(self.session.start_text)]
+        return out
+
+    def format_output(self, out):
+        return out if self.encoding or self.codec else bytes2base64(out)
+
+    def parse_output(self, out, res=None):
+        res = self.res if res is None else res
+        start = time.monotonic()
+        res['stdout'] = self.format_output(self.strip_prompt(out))
+        self.phase('decode', start, res)
+        res['code'] = ReCode.SUCCESS
+
+    async def connect(self):
+        pool = Context.CTX.telnet_pool
+        # 会话的读写模式由encoding决定，不同模式的会话不能混用
+        key = pool.make_key(self.connect_info) + (self.encoding or '',)
+        self.phase('queue', self.clock)
+        start = time.monotonic()
+        self.entry = await pool.acquire(self.connect_info, key=key, encoding=self.encoding, prompts=self._prompts,
+                                        idle_timeout=self.idle_timeout, login_timeout=self.login_timeout)
+        self.conn_phase(self.entry, start)
+        self.session = self.entry.conn
 
     async def write(self, data):
-        data = data + '\n' if self.encoding else data.encode() + b'\n'
-        self.writer.write(data)
-        await self.writer.drain()
+        await self.session.write(data)
 
     async def parse_cmd(self, cmd):
         await self.write(cmd)
-        res = await self.read_all()
+        res = await self.read_until_prompt()
         # TODO temp
         # if ('E437') in res:
         #     res = await self.parse_cmd('')
         return res
 
-    async def read_all(self):
-        # TODO should we set timeout or others?
-        res = '' if self.encoding else b''
-        while True:
-            bl = len(self.reader._buffer)
-            res += await self.reader.read(bl)
-            await asyncio.sleep(2)
-            if not self.reader._buffer:
-                break
-        return res
-
+    async def read_until_prompt(self, on_data=None):
+        return await self.session.read_until_prompt(total_timeout=self.timeout, on_data=on_data)
 
-class LoginError(Exception):
-    pass
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
 import time
 
-from utils.ip_utils import is_ipv4, is_ipv6
+from utils.ip_utils import TargetDenied, address, is_ipv4, is_ipv6, iter_target
 from core import Context
-from core.enums import GatherProto, ShellReplyCode
+from core.enums import GatherProto, ShellReplyCode, ShellReplyMessage, TaskType
 
 from moudle.cmd import AsyncSSH, TelnetConn, AsyncWinRM
 
@@ -59,22 +60,36 @@ class Task:
                 account=self.account
             )
             self.exec_cls = self.chose_cls(self.connect_info.proto)(connect_info=self.connect_info, reply_to=self.reply_to,
-                                                                    body=self.body)
+                                                                    body=self.body, message=self.msg)
             return True
+        except TargetDenied as e:
+            logger.warning('Task {} rejected: {}'.format(self.id, e))
+            self.reply_error(e, code=ShellReplyCode.TARGET_DENIED, message=self.msg)
+            return False
         except Exception as e:
             logger.warning(e, exc_info=True)
-            if self.reply_to:
-                res = {'id': self.id, 'cmd': '', 'encoding': self.encoding or '', 'stdout': '', 'stderr': '',
-                       'returncode': None, 'code': ShellReplyCode.AUTHENTICATED_FAILED, 'err_info': str(e),
-                       'start_time': time.time(), 'end_time': time.time()}
-                exchange = str(self.reply_to).split('/')[0]
-                routing_key = str(self.reply_to).split('/')[1]
-                try:
-                    Context.CTX.mq.send_as_task(res, exchange=exchange, routing_key=routing_key)
-                except Exception as e:
-                    logger.error('Failed to sent task {} result, reason {}'.format(self.id, e), exc_info=True)
+            self.reply_error(e, message=self.msg)
             return False
 
+    def reply_error(self, err, code=ShellReplyCode.AUTHENTICATED_FAILED, message=None, **kwargs):
+        if self.reply_to:
+            res = {'id': self.id, 'cmd': '', 'encoding': self.encoding or '', 'stdout': '', 'stderr': '',
+                   'returncode': None, 'code': code, 'err_info': str(err),
+                   'start_time': time.time(), 'end_time': time.time()}
+            res.update(kwargs)
+            self.send(res, message=message)
+        else:
+            Context.CTX.mq.ack(message)
+
+    def send(self, res, message=None):
+        # message不为空时，回复发出后确认该任务消息
+        exchange = str(self.reply_to).split('/')[0]
+        routing_key = str(self.reply_to).split('/')[1]
+        try:
+            Context.CTX.mq.send_as_task(res, exchange=exchange, routing_key=routing_key, message=message)
+        except Exception as e:
+            logger.error('Failed to sent task {} result, reason {}'.format(self.id, e), exc_info=True)
+
     def run(self):
         self.exec_cls.run()
 
@@ -89,6 +104,128 @@ class Task:
         raise ValueError('No support protocol %s' % proto)
 
 
+class FanoutTask(Task):
+    __slots__ = ('hosts', 'total', 'failed', 'start_time')
+
+    def __init__(self, body, message):
+        super().__init__(body, message)
+        self.hosts = None
+        self.total = 0
+        self.failed = 0
+        self.start_time = None
+
+    def check(self):
+        try:
+            assert self.body, 'Task body is empty'
+            self.id = self['id']
+            logger.info('Start parsing fanout task id : {}'.format(self.id))
+            assert ('reply_to' in self.msg.properties), 'Task without reply_to'
+            self.reply_to = self.msg.properties["reply_to"]
+            assert isinstance(self['account'], dict), 'Not account info'
+            self.account = Account(
+                username=self['account'].get('username'),
+                password=self['account'].get('password')
+            )
+            assert isinstance(self['conn'], dict), 'Not connection info'
+            self.hosts = self['conn'].get('hosts')
+            if isinstance(self.hosts, str):
+                self.hosts = [self.hosts]
+            assert self.hosts and isinstance(self.hosts, list), 'Not hosts'
+            self.chose_cls(self['conn'].get('proto'))
+            assert isinstance(self['task'], dict) and self['task'].get('cmd'), 'not exist cmd'
+            return True
+        except Exception as e:
+            logger.warning(e, exc_info=True)
+            self.reply_error(e, message=self.msg)
+            return False
+
+    def run(self):
+        self.start_time = time.time()
+        Context.CTX.coro.add_task(self.async_task(), key=self.id, batch=self['batch_id'])
+
+    def new_exec(self, ip):
+        connect_info = Connection(
+            ip=ip,
+            port=self['conn'].get('port'),
+            sys_type=self['conn'].get('sysType'),
+            proto=self['conn'].get('proto'),
+            encoding=self['conn'].get('encoding'),
+            account=self.account
+        )
+        exec_cls = self.chose_cls(connect_info.proto)(connect_info=connect_info, reply_to=self.reply_to,
+                                                      body=self.body)
+        exec_cls.res['host'] = ip
+        return exec_cls
+
+    async def async_task(self):
+        # 逐个展开目标，先拿到调度槽位再创建该主机的协程，内存占用与目标总数无关
+        scheduler = Context.CTX.coro.scheduler
+        pending = set()
+        code, err_info = ShellReplyCode.SUCCESS, ''
+        try:
+            for target in self.hosts:
+                try:
+                    for ip in iter_target(target):
+                        if self.denied(ip):
+                            continue
+                        await scheduler.acquire(ip)
+                        self.total += 1
+                        task = asyncio.ensure_future(self.run_host(ip))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                        task.add_done_callback(lambda _, host=ip: scheduler.release(host))
+                except ValueError as e:
+                    logger.warning('Fanout task {} invalid target {}: {}'.format(self.id, target, e))
+                    self.failed += 1
+                    self.reply_error(e, code=ShellReplyCode.UNKNOWN_ERROR, host=str(target))
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        except asyncio.exceptions.CancelledError:
+            # 已在执行的主机各自回复取消结果，未展开的目标不再执行
+            code, err_info = ShellReplyCode.MANUAL_CANCELLED, ShellReplyMessage.MANUAL_CANCELLED
+            for task in list(pending):
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            # 整个扫描结束后才确认任务消息
+            self.send({'id': self.id, 'type': TaskType.FANOUT, 'done': True, 'total': self.total,
+                       'failed': self.failed, 'code': code, 'err_info': err_info,
+                       'start_time': self.start_time, 'end_time': time.time()}, message=self.msg)
+            logger.info('Fanout task {} end, {} hosts, {} failed'.format(self.id, self.total, self.failed))
+
+    def denied(self, ip):
+        # 范围外的目标在占用调度槽位前直接回复
+        targets = Context.CTX.targets
+        if targets is None:
+            return False
+        # localhost与Connection.check一致先转换为127.0.0.1，主机名等非ip目标交给每个连接的检查处理
+        target = '127.0.0.1' if ip == 'localhost' else ip
+        if address(target) is None or targets.permits(target):
+            return False
+        self.failed += 1
+        self.reply_error(TargetDenied('Target {} is out of scope'.format(ip)), code=ShellReplyCode.TARGET_DENIED,
+                         host=ip)
+        return True
+
+    async def run_host(self, ip):
+        try:
+            exec_cls = self.new_exec(ip)
+        except TargetDenied as e:
+            self.failed += 1
+            self.reply_error(e, code=ShellReplyCode.TARGET_DENIED, host=ip)
+            return
+        except Exception as e:
+            self.failed += 1
+            self.reply_error(e, code=ShellReplyCode.UNKNOWN_ERROR, host=ip)
+            return
+        exec_cls.res['start_time'] = time.time()
+        if not exec_cls.short_circuit():
+            await exec_cls.async_task()
+        if exec_cls.res['code'] < 0:
+            self.failed += 1
+
+
 class Connection:
     __slots__ = ('ip', 'port', 'sys_type', 'proto', 'encoding', 'account')
 
@@ -113,6 +250,10 @@ class Connection:
                 raise ValueError('Not support ipv6 yet')
             else:
                 raise ValueError('Invalid ip')
+        # 只允许访问配置范围内的网段，在建立任何连接之前拒绝
+        targets = Context.CTX.targets if Context.CTX else None
+        if targets is not None and not targets.permits(self.ip):
+            raise TargetDenied('Target {} is out of scope'.format(self.ip))
 
         if not isinstance(self.port, int):
             try:
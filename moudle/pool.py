@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+from core import metrics
+from core.breaker import CircuitOpen
+from moudle.telnet import LoginError, ReadTimeout, TelnetSession
+from utils.lazy_utils import lazy_import
+
+logger = logging.getLogger(__name__)
+
+asyncssh = lazy_import('asyncssh')
+telnetlib3 = lazy_import('telnetlib3')
+httpx = lazy_import('httpx')
+asyncwinrm = lazy_import('asyncwinrm')
+
+
+class PoolEntry:
+    __slots__ = ('key', 'conn', 'token', 'created', 'last_used', 'refs', 'uses', 'phases')
+
+    def __init__(self, key, conn, token=None):
+        self.key = key
+        self.conn = conn
+        self.token = token
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.refs = 0
+        # uses: 被获取的次数；phases: 建立连接时各阶段耗时
+        self.uses = 1
+        self.phases = None
+
+    def __str__(self):
+        return "PoolEntry[key:%s refs:%s]" % (self.key[:2], self.refs)
+
+
+# 协程循环上按目标缓存的连接池，key按LRU排序，每个key最多max_per_host个连接，
+# 每个连接同时最多被max_refs个任务使用
+class ConnPool:
+    proto = ''
+
+    def __init__(self, max_size=200, max_per_host=2, max_refs=1, idle_ttl=60, reap_interval=10):
+        self.max_size = max_size
+        self.max_per_host = max_per_host
+        self.max_refs = max_refs
+        self.idle_ttl = idle_ttl
+        self.reap_interval = reap_interval
+        self._entries = OrderedDict()
+        self._opening = {}
+        self._size = 0
+        self._cond = None
+        self._reaper = None
+        self.rate_limiter = None
+        self.breaker = None
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def make_key(connect_info):
+        return connect_info.ip, connect_info.port, connect_info.account.username
+
+    @staticmethod
+    def make_token(connect_info):
+        # 同一账号密码变更后不能复用旧的已认证连接
+        return hashlib.sha1(str(connect_info.account.password).encode()).hexdigest()
+
+    async def open(self, connect_info):
+        raise NotImplementedError(f'{self.__class__.__name__}.open is not defined')
+
+    async def check(self, conn):
+        raise NotImplementedError(f'{self.__class__.__name__}.check is not defined')
+
+    async def close(self, conn):
+        raise NotImplementedError(f'{self.__class__.__name__}.close is not defined')
+
+    def phases(self, conn):
+        # 新建连接各阶段的耗时(秒)，由子类按协议提供
+        return None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+            if self.reap_interval and self.idle_ttl > 0:
+                self._reaper = asyncio.ensure_future(self._reap_loop())
+        return self._cond
+
+    def _count(self, key):
+        return len(self._entries.get(key, ())) + self._opening.get(key, 0)
+
+    async def acquire(self, connect_info, weight=1, key=None, **options):
+        # weight: 本次占用的引用数，如一个任务在同一连接上并行打开的channel数
+        # options: 需要新建连接时传给open的参数
+        key = key or self.make_key(connect_info)
+        token = self.make_token(connect_info)
+        weight = max(1, min(weight, self.max_refs))
+        while True:
+            entry = await self._reserve(key, token, weight)
+            if entry is None:
+                return await self._open_entry(key, token, connect_info, weight, options)
+            try:
+                alive = await self.check(entry.conn)
+            except Exception:
+                alive = False
+            if alive:
+                return entry
+            logger.debug('Discard dead connection {}'.format(entry))
+            await self.release(entry, discard=True, weight=weight)
+
+    async def _reserve(self, key, token, weight=1):
+        cond = self._condition()
+        async with cond:
+            while True:
+                for entry in self._entries.get(key, ()):
+                    if entry.refs + weight <= self.max_refs and entry.token == token:
+                        entry.refs += weight
+                        entry.uses += 1
+                        entry.last_used = time.monotonic()
+                        self._entries.move_to_end(key)
+                        return entry
+                if self._count(key) < self.max_per_host:
+                    self._opening[key] = self._opening.get(key, 0) + 1
+                    return None
+                if not self._evict_idle(key, token):
+                    await cond.wait()
+
+    def unreachable(self, exc):
+        # 判断建立连接时的异常是否说明目标不可达，计入断路器的失败次数
+        return isinstance(exc, (OSError, asyncio.TimeoutError))
+
+    def record(self, target, exc=None):
+        if self.breaker is None or isinstance(exc, CircuitOpen):
+            return
+        if exc is None:
+            self.breaker.success(target)
+        elif isinstance(exc, asyncio.CancelledError):
+            self.breaker.abort(target)
+        elif self.unreachable(exc):
+            self.breaker.failure(target)
+        else:
+            # 认证失败等错误说明目标可达
+            self.breaker.success(target)
+
+    async def _open_entry(self, key, token, connect_info, weight=1, options=None):
+        cond = self._condition()
+        target = (connect_info.ip, connect_info.port)
+        try:
+            if self.breaker:
+                self.breaker.acquire(target)
+            await self._make_room()
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+            with metrics.CONNECT_SECONDS.time(proto=self.proto):
+                conn = await self.open(connect_info, **(options or {}))
+        except BaseException as e:
+            self.record(target, e)
+            async with cond:
+                self._opening[key] -= 1
+                if not self._opening[key]:
+                    del self._opening[key]
+                cond.notify_all()
+            raise
+        self.record(target)
+        entry = PoolEntry(key, conn, token)
+        entry.refs = weight
+        entry.phases = self.phases(conn)
+        async with cond:
+            self._opening[key] -= 1
+            if not self._opening[key]:
+                del self._opening[key]
+            self._entries.setdefault(key, []).append(entry)
+            self._entries.move_to_end(key)
+            self._size += 1
+        return entry
+
+    async def release(self, entry, discard=False, weight=1):
+        cond = self._condition()
+        entry.refs -= max(1, min(weight, self.max_refs))
+        entry.last_used = time.monotonic()
+        if not discard and self.idle_ttl <= 0 and entry.refs <= 0:
+            discard = True
+        async with cond:
+            if discard:
+                self._remove(entry)
+            pooled = entry in self._entries.get(entry.key, ())
+            cond.notify_all()
+        if not pooled and entry.refs <= 0:
+            await self._close(entry)
+
+    def _remove(self, entry):
+        entries = self._entries.get(entry.key)
+        if entries and entry in entries:
+            entries.remove(entry)
+            self._size -= 1
+            if not entries:
+                del self._entries[entry.key]
+
+    def _evict_idle(self, key, token):
+        # 同一目标上认证信息不同的空闲连接，让位给新的认证信息
+        for entry in list(self._entries.get(key, ())):
+            if entry.refs <= 0 and entry.token != token:
+                self._remove(entry)
+                asyncio.ensure_future(self._close(entry))
+                return True
+        return False
+
+    async def _make_room(self):
+        expired = []
+        async with self._condition():
+            over = self._size + sum(self._opening.values()) - self.max_size
+            for key in list(self._entries):
+                if over <= 0:
+                    break
+                for entry in list(self._entries[key]):
+                    if entry.refs <= 0:
+                        self._remove(entry)
+                        expired.append(entry)
+                        over -= 1
+                        if over <= 0:
+                            break
+        for entry in expired:
+            logger.debug('Evict connection {}'.format(entry))
+            await self._close(entry)
+
+    async def _close(self, entry):
+        try:
+            await self.close(entry.conn)
+        except Exception as e:
+            logger.debug('Close connection {} failed: {}'.format(entry, e))
+
+    async def reap(self):
+        expired = []
+        now = time.monotonic()
+        async with self._condition():
+            for key in list(self._entries):
+                for entry in list(self._entries[key]):
+                    if entry.refs <= 0 and now - entry.last_used >= self.idle_ttl:
+                        self._remove(entry)
+                        expired.append(entry)
+        for entry in expired:
+            await self._close(entry)
+        return len(expired)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    async def clear(self):
+        async with self._condition():
+            entries = [entry for key in self._entries for entry in self._entries[key]]
+            self._entries.clear()
+            self._size = 0
+        for entry in entries:
+            await self._close(entry)
+
+
+class PhaseRecorder:
+    # 记录tcp建立、密钥交换、认证完成的时刻
+    def __init__(self):
+        self.start = time.monotonic()
+        self.made = self.kex = self.auth = None
+
+    def connection_made(self, conn):
+        self.made = time.monotonic()
+
+    def begin_auth(self, username):
+        self.kex = time.monotonic()
+
+    def auth_completed(self):
+        self.auth = time.monotonic()
+
+    def phases(self):
+        if not (self.made and self.kex and self.auth):
+            return None
+        return {'tcp': round(self.made - self.start, 6), 'kex': round(self.kex - self.made, 6),
+                'auth': round(self.auth - self.kex, 6)}
+
+
+_phase_client = None
+
+
+def phase_client():
+    # asyncssh.SSHClient子类在第一次建立ssh连接时才创建，避免启动时导入asyncssh
+    global _phase_client
+    if _phase_client is None:
+        _phase_client = type('PhaseClient', (PhaseRecorder, asyncssh.SSHClient), {})
+    return _phase_client
+
+
+class SSHPool(ConnPool):
+    proto = 'ssh'
+
+    def __init__(self, max_channels=8, connect_timeout=10, **kwargs):
+        # 每个连接上同时打开的channel数，不超过sshd的MaxSessions(默认10)
+        super().__init__(max_refs=max_channels, **kwargs)
+        self.connect_timeout = connect_timeout
+
+    async def open(self, connect_info):
+        return await asyncssh.connect(
+            host=connect_info.ip,
+            port=connect_info.port,
+            username=connect_info.account.username,
+            password=connect_info.account.password,
+            known_hosts=None,
+            client_factory=phase_client(),
+            connect_timeout=self.connect_timeout)
+
+    def unreachable(self, exc):
+        return super().unreachable(exc) or isinstance(exc, asyncssh.ConnectionLost)
+
+    def phases(self, conn):
+        client = conn.get_owner()
+        return client.phases() if isinstance(client, PhaseRecorder) else None
+
+    async def check(self, conn):
+        return not conn.is_closed()
+
+    async def close(self, conn):
+        conn.close()
+        await conn.wait_closed()
+
+
+class TelnetPool(ConnPool):
+    proto = 'telnet'
+    user_ps = b'login:'
+    pass_ps = b'Password:'
+    success_match = '(?i)(Last login:|Last failed login:)'
+    success_match_byte = b'(?i)(Last login:|Last failed login:)'
+    fail_match = r'(?i)(incorrect|failed|denied|invalid|login:\s*$|password:\s*$)'
+    # 登录时用于识别提示符的默认正则，登录成功后改用学习到的提示符
+    default_prompts = [r'[>#$%\]]\s?$']
+
+    def __init__(self, max_per_host=2, resync_timeout=3, idle_timeout=2, login_timeout=10, prompts=None, **kwargs):
+        # 一个telnet会话同一时间只能执行一个任务；max_per_host受设备vty会话数限制
+        super().__init__(max_per_host=max_per_host, max_refs=1, **kwargs)
+        self.resync_timeout = resync_timeout
+        self.idle_timeout = idle_timeout
+        self.login_timeout = login_timeout
+        self.prompts = prompts or TelnetPool.default_prompts
+
+    async def open(self, connect_info, encoding=False, prompts=None, idle_timeout=None, login_timeout=None):
+        # 建立连接并登录；encoding决定会话按文本还是字节读写，其余参数未指定时使用连接池的配置
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        login_timeout = self.login_timeout if login_timeout is None else login_timeout
+        start = time.monotonic()
+        reader, writer = await telnetlib3.open_connection(
+            connect_info.ip, connect_info.port, encoding=encoding or False, connect_maxwait=5.0)
+        made = time.monotonic()
+        session = TelnetSession(reader, writer, encoding, idle_timeout=idle_timeout)
+        session.prompts = [session.compile(p) for p in prompts or self.prompts]
+        try:
+            try:
+                _ = await asyncio.wait_for(reader.readuntil(self.user_ps), login_timeout)
+                await session.write(connect_info.account.username)
+                _ = await asyncio.wait_for(reader.readuntil(self.pass_ps), login_timeout)
+            except asyncio.TimeoutError:
+                raise ReadTimeout
+            await session.write(connect_info.account.password)
+            login_res = await session.read_until_prompt(total_timeout=login_timeout)
+            if re.search(self.success_match if encoding else self.success_match_byte, login_res) or \
+                    (session.synced and not re.search(session.compile(self.fail_match), login_res[-256:])):
+                session.phases = {'tcp': round(made - start, 6), 'auth': round(time.monotonic() - made, 6)}
+                session.learn_prompt(login_res)
+                session.synced = True
+                return session
+            raise LoginError
+        except BaseException:
+            session.close()
+            raise
+
+    async def check(self, session):
+        return await session.resync(self.resync_timeout)
+
+    def phases(self, session):
+        return session.phases
+
+    async def close(self, session):
+        session.close()
+
+
+class WinRMClient:
+    # 目标主机上缓存的WinRM会话，共享keep-alive的http连接，空闲的shell在命令间复用
+    __slots__ = ('session', 'protocol', 'shells', 'closed')
+
+    def __init__(self, session):
+        self.session = session
+        self.protocol = session.protocol
+        self.shells = []
+        self.closed = False
+
+    async def open_shell(self):
+        if self.shells:
+            return self.shells.pop()
+        return await self.protocol.open_shell()
+
+    async def release_shell(self, shell_id, reuse=True):
+        # 命令异常结束的shell状态不确定，直接关闭
+        if reuse and not self.closed:
+            self.shells.append(shell_id)
+        else:
+            await self.protocol.close_shell(shell_id, close_session=False)
+
+    async def close(self):
+        self.closed = True
+        shells, self.shells = self.shells, []
+        for shell_id in shells:
+            try:
+                await self.protocol.close_shell(shell_id, close_session=False)
+            except Exception as e:
+                logger.debug('Close shell {} failed: {}'.format(shell_id, e))
+        await self.protocol.transport.close_session()
+
+
+class WinRMPool(ConnPool):
+    proto = 'winrm'
+
+    def __init__(self, max_shells=5, keepalive_expiry=60, **kwargs):
+        # 每个会话同时打开的shell数，不超过服务端MaxShellsPerUser
+        super().__init__(max_refs=max_shells, **kwargs)
+        self.max_shells = max_shells
+        self.keepalive_expiry = keepalive_expiry
+        self._limits = None
+
+    @property
+    def limits(self):
+        if self._limits is None:
+            self._limits = httpx.Limits(max_connections=self.max_shells, max_keepalive_connections=self.max_shells,
+                                        keepalive_expiry=self.keepalive_expiry)
+        return self._limits
+
+    @staticmethod
+    def make_target(connect_info):
+        if connect_info.port:
+            return "{}:{}".format(connect_info.ip, connect_info.port)
+        return connect_info.ip
+
+    async def open(self, connect_info):
+        session = asyncwinrm.Session(self.make_target(connect_info),
+                                     auth=(connect_info.account.username, connect_info.account.password))
+        transport = session.protocol.transport
+        # 按认证方式构建http会话后，换成保持长连接的连接池，认证只在建立连接时进行
+        transport.build_session()
+        built = transport.session
+        transport.session = httpx.AsyncClient(limits=self.limits, **self.client_settings(transport, built))
+        await built.aclose()
+        client = WinRMClient(session)
+        # 先打开一个shell，主机可达且认证通过后才放入连接池，第一条命令直接复用该shell
+        try:
+            await client.release_shell(await client.open_shell())
+        except BaseException:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.debug('Close winrm session failed: {}'.format(e))
+            raise
+        return client
+
+    @staticmethod
+    def client_settings(transport, client):
+        # 沿用asyncwinrm构建的http会话的认证、请求头与超时，证书校验与客户端证书按transport的配置设置
+        settings = {'auth': client.auth, 'headers': client.headers, 'timeout': client.timeout,
+                    'verify': transport.server_cert_validation != 'ignore'}
+        if settings['verify'] and transport.ca_trust_path not in (None, 'legacy_requests'):
+            settings['verify'] = transport.ca_trust_path
+        if getattr(client, 'cert', None):
+            settings['cert'] = client.cert
+        return settings
+
+    def unreachable(self, exc):
+        return super().unreachable(exc) or isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+
+    async def check(self, client):
+        return not client.closed and client.protocol.transport.session is not None
+
+    async def close(self, client):
+        await client.close()
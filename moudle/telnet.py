@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import re
+
+
+class LoginError(Exception):
+    pass
+
+
+class ReadTimeout(Exception):
+    pass
+
+
+class TelnetSession:
+    # 已登录的telnet会话，由TelnetPool缓存，在同一设备的多个任务间复用
+    __slots__ = ('reader', 'writer', 'encoding', 'prompts', 'prompt', 'start_text', 'idle_timeout', 'synced',
+                 'phases')
+    read_size = 4096
+
+    def __init__(self, reader, writer, encoding=False, prompts=None, idle_timeout=2):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+        self.prompts = prompts or []
+        self.prompt = None
+        self.start_text = None
+        self.idle_timeout = idle_timeout
+        self.synced = True
+        self.phases = None
+
+    def compile(self, pattern):
+        if isinstance(pattern, str) and not self.encoding:
+            pattern = pattern.encode()
+        return re.compile(pattern)
+
+    def learn_prompt(self, login_res):
+        # 学习登录后的提示符，后续命令读到该提示符即返回
+        self.start_text = login_res.split('\r\n' if self.encoding else b'\r\n')[-1]
+        if self.start_text.strip():
+            self.prompt = re.compile(re.escape(self.start_text.rstrip()) + (r'\s*$' if self.encoding else rb'\s*$'))
+
+    def match_prompt(self, out, prompts=None):
+        tail = out[-256:]
+        return any(p.search(tail) for p in (prompts or ([self.prompt] if self.prompt else self.prompts)))
+
+    async def write(self, data):
+        data = data + '\n' if self.encoding else data.encode() + b'\n'
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read_until_prompt(self, prompts=None, idle_timeout=None, total_timeout=100, on_data=None):
+        # 读到提示符立即返回；空闲idle_timeout无新数据时认为输出结束；超过total_timeout抛出ReadTimeout
+        # on_data: 流式模式下每读到一段数据即回调，不再在内存中累积
+        loop = asyncio.get_running_loop()
+        idle_timeout = idle_timeout or self.idle_timeout
+        deadline = loop.time() + total_timeout
+        res = tail = '' if self.encoding else b''
+        self.synced = False
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise ReadTimeout
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.read_size), min(idle_timeout, remaining))
+            except asyncio.TimeoutError:
+                if loop.time() >= deadline:
+                    raise ReadTimeout
+                break
+            if not data:
+                break
+            if on_data:
+                on_data(data)
+                tail = (tail + data)[-256:]
+            else:
+                res += data
+                tail = res
+            if self.match_prompt(tail, prompts):
+                self.synced = True
+                break
+        return res
+
+    async def resync(self, timeout=3, drain_timeout=0.05):
+        # 复用前清空残留输出并确认提示符，保证下一条命令的输出与提示符对齐
+        if self.closed:
+            return False
+        if self.synced:
+            # 上次读到了提示符且之后没有新的输出，可直接复用
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.read_size), drain_timeout)
+            except asyncio.TimeoutError:
+                return True
+            if not data:
+                return False
+        await self.write('')
+        await self.read_until_prompt(idle_timeout=timeout, total_timeout=timeout)
+        return self.synced
+
+    @property
+    def closed(self):
+        return self.reader.at_eof() or self.writer.transport is None or self.writer.transport.is_closing()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.context import Context  # noqa: E402
+
+USERNAME, PASSWORD = 'u', 'pw'
+
+
+class MemoryMQ:
+    # 代替RabbitMQ，记录所有回复
+    def __init__(self):
+        self.sent = []
+
+    def send_as_task(self, data, **kwargs):
+        self.sent.append(data)
+
+    def ack(self, message):
+        pass
+
+    def reject(self, message, requeue=False):
+        pass
+
+    def replies(self, task_id):
+        return [data for data in self.sent if isinstance(data, dict) and data.get('id') == task_id
+                and 'seq' not in data]
+
+    def wait_reply(self, task_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            replies = self.replies(task_id)
+            if replies:
+                return replies[-1]
+            time.sleep(0.02)
+        raise AssertionError('no reply for task {}'.format(task_id))
+
+
+class Message:
+    def __init__(self, reply_to='ex/rk'):
+        self.properties = {'reply_to': reply_to}
+        self.headers = {}
+        self.delivery_info = {}
+        self.content_type = 'application/json'
+
+    def ack(self):
+        pass
+
+
+@pytest.fixture
+def conf():
+    return {'VERSION': 'test', 'MQ_CONFIG': {}, 'METRICS_CONFIG': {'enable': False}}
+
+
+@pytest.fixture
+def ctx(conf):
+    Context.CTX = None
+    Context.CONF = conf
+    context = Context(None)
+    context.mq = MemoryMQ()
+    context.register_coroutine()
+    context.register_pool()
+    yield context
+    loop = context.coroutine.loop
+    run_in_loop(context, shutdown(context))
+    loop.call_soon_threadsafe(loop.stop)
+    context.coroutine.join(10)
+    Context.CTX = None
+    Context.CONF = None
+
+
+def run_in_loop(ctx, coro, timeout=10):
+    return asyncio.run_coroutine_threadsafe(coro, ctx.coroutine.loop).result(timeout)
+
+
+async def shutdown(context):
+    # 关闭池中的连接并取消循环上剩余的任务(连接池的回收任务、服务端未结束的命令等)
+    for conn_pool in (context.ssh_pool, context.telnet_pool, context.winrm_pool):
+        await conn_pool.clear()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def ssh_server(ctx):
+    # 本地ssh服务：sleep <秒>命令按时长阻塞，其他命令回显，端口为server.port
+    import asyncssh
+
+    connections = []
+
+    class Server(asyncssh.SSHServer):
+        def connection_made(self, conn):
+            connections.append(conn)
+
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return password == PASSWORD
+
+    async def handle(process):
+        cmd = process.command or ''
+        if cmd.startswith('sleep'):
+            await asyncio.sleep(float(cmd.split()[1]))
+        process.stdout.write('out:{}\n'.format(cmd))
+        process.exit(0)
+
+    async def start():
+        key = asyncssh.generate_private_key('ssh-ed25519')
+        return await asyncssh.create_server(Server, '127.0.0.1', 0, server_host_keys=[key], process_factory=handle)
+
+    server = run_in_loop(ctx, start())
+    server.port = server.sockets[0].getsockname()[1]
+    # 服务端的连接，用于检查远端的channel是否关闭
+    server.connections = connections
+    yield server
+    server.close()
+
+
+def gather_body(task_id, port, cmd, proto='ssh', **task):
+    return {'id': task_id, 'type': 'gather', 'encoding': 'utf-8',
+            'account': {'username': USERNAME, 'password': PASSWORD},
+            'conn': {'ip': '127.0.0.1', 'port': port, 'proto': proto}, 'task': dict(task, cmd=cmd)}
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from core.rabbitmq import RabbitMQ
+from core.scheduler import Scheduler
+
+
+async def hold(scheduler, host, hosts, release):
+    async with scheduler.slot(host):
+        hosts.append(host)
+        await release.wait()
+
+
+def test_prefetch_ignores_tasks_waiting_on_host_caps():
+    async def main():
+        scheduler = Scheduler(capacity=10, per_host=2)
+        release = asyncio.Event()
+        started = []
+        # 单主机积压：只有per_host个任务在执行，其余在调度器中等待
+        tasks = [asyncio.ensure_future(hold(scheduler, '10.0.0.1', started, release)) for _ in range(50)]
+        await asyncio.sleep(0)
+        assert scheduler.running == 2 and scheduler.waiting == 48
+        limits = [scheduler.prefetch(unacked) for unacked in (50, 500)]
+        release.set()
+        await asyncio.gather(*tasks)
+        return limits
+
+    assert asyncio.run(main()) == [10, 10]
+
+
+def test_prefetch_follows_free_slots():
+    scheduler = Scheduler(capacity=10)
+    assert scheduler.prefetch(0) == 10
+    scheduler.running = 10
+    # 全部槽位都在执行，等待回复确认的消息不再增加预取
+    assert scheduler.prefetch(10) == 10
+    assert scheduler.prefetch(0) == 1
+
+
+class Consumer:
+    def __init__(self):
+        self.prefetch = []
+
+    def qos(self, prefetch_count):
+        self.prefetch.append(prefetch_count)
+
+
+def test_consumer_qos_stays_within_capacity():
+    async def main():
+        scheduler = Scheduler(capacity=10, per_host=1)
+        release = asyncio.Event()
+        tasks = [asyncio.ensure_future(hold(scheduler, '10.0.0.1', [], release)) for _ in range(30)]
+        await asyncio.sleep(0)
+        mq = RabbitMQ.__new__(RabbitMQ)
+        mq._prefetch, mq._qos_time, mq.unacked = 10, 0, 30
+        consumer = Consumer()
+        for _ in range(3):
+            mq._qos_time = 0
+            mq.unacked += 30
+            mq._sync_qos(consumer, scheduler.prefetch)
+        release.set()
+        await asyncio.gather(*tasks)
+        return consumer.prefetch, mq._prefetch
+
+    assert asyncio.run(main()) == ([], 10)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import json
+import uuid
+from datetime import date, datetime
+
+import pytest
+
+from utils import serialize_utils
+
+TASK_ID = uuid.UUID('12345678-1234-5678-1234-567812345678')
+
+
+def payload():
+    return {'id': TASK_ID, 'cmd': ['uname -a', 'hostname'], 'code': 0, 'encoding': 'utf-8',
+            'stdout': '输出 out', 'returncode': 0, 'start_time': datetime(2024, 1, 2, 3, 4, 5),
+            'day': date(2024, 1, 2), 'raw': b'bytes', 'ids': (TASK_ID, uuid.UUID(int=1)),
+            'results': [{'cmd': 'hostname', 'id': TASK_ID, 'timing': {'exec': 7e-06}}], 1: 'int key'}
+
+
+def stdlib_json(data):
+    return serialize_utils._json_dumps(data)
+
+
+def test_orjson_matches_stdlib_json():
+    pytest.importorskip('orjson')
+    data = payload()
+    fast = serialize_utils._orjson_dumps(data)
+    # 两种实现的分隔符与浮点格式可能不同，解码后的内容必须一致
+    assert json.loads(fast) == json.loads(stdlib_json(data))
+    assert json.loads(fast)['id'] == TASK_ID.hex
+    assert TASK_ID.hex.encode() in fast and str(TASK_ID).encode() not in fast
+
+
+def test_msgpack_matches_stdlib_json():
+    pytest.importorskip('msgpack')
+    data = payload()
+    body, content_type, _ = serialize_utils.dumps(data, serialize_utils.MSGPACK)
+    decoded = serialize_utils.loads(body, content_type)
+    expected = json.loads(stdlib_json(data))
+    # msgpack保留整数键与原始字节，其余内容与json一致
+    assert decoded.pop(1) == expected.pop('1')
+    assert decoded.pop('raw') == b'bytes' and expected.pop('raw') == 'bytes'
+    assert decoded == expected
+
+
+def test_reply_format_roundtrip():
+    data = payload()
+    body, content_type, _ = serialize_utils.dumps(data)
+    assert serialize_utils.loads(body, content_type) == json.loads(stdlib_json(data))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from core.dispatch import Dispatcher
+from core.enums import ShellReplyCode as ReCode
+
+from conftest import Message, gather_body
+
+
+def pooled_entries(ctx):
+    return [entry for entries in ctx.ssh_pool._entries.values() for entry in entries]
+
+
+def open_channels(entry):
+    return len(entry.conn._channels)
+
+
+def remote_channels(server):
+    return sum(len(conn._channels) for conn in server.connections)
+
+
+def test_timeout_closes_channel(ctx, ssh_server):
+    Dispatcher.dispatch(gather_body('slow', ssh_server.port, 'sleep 5', mto=0.3), Message())
+    assert ctx.mq.wait_reply('slow')['code'] == ReCode.HIT_EOF_TIME_OUT
+
+    entries = pooled_entries(ctx)
+    assert len(entries) == 1
+    assert entries[0].refs == 0 and not entries[0].conn.is_closed()
+    assert open_channels(entries[0]) == 0
+    assert remote_channels(ssh_server) == 0
+
+    # 连接放回池中后可继续复用
+    Dispatcher.dispatch(gather_body('next', ssh_server.port, 'echo ok'), Message())
+    reply = ctx.mq.wait_reply('next')
+    assert reply['code'] == ReCode.SUCCESS and reply['stdout'] == 'out:echo ok\n'
+    assert pooled_entries(ctx) == entries
+
+
+def test_multi_command_timeout_closes_channels(ctx, ssh_server):
+    body = gather_body('multi', ssh_server.port, ['sleep 5', 'echo a', 'sleep 5'], mto=0.3, concurrency=3)
+    Dispatcher.dispatch(body, Message())
+    reply = ctx.mq.wait_reply('multi')
+    assert [item['code'] for item in reply['results']] == [ReCode.HIT_EOF_TIME_OUT, ReCode.SUCCESS,
+                                                           ReCode.HIT_EOF_TIME_OUT]
+    assert all(open_channels(entry) == 0 for entry in pooled_entries(ctx))
+    assert remote_channels(ssh_server) == 0
+
+
+def wait_running(ctx, server, task_id, timeout=5):
+    # 等到本端与远端都打开了命令的channel
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        entries = pooled_entries(ctx)
+        if entries and open_channels(entries[0]) and remote_channels(server):
+            return entries[0]
+        time.sleep(0.02)
+    raise AssertionError('task {} did not start'.format(task_id))
+
+
+def test_stop_closes_channel(ctx, ssh_server):
+    Dispatcher.dispatch(gather_body('runaway', ssh_server.port, 'sleep 30', mto=60), Message())
+    entry = wait_running(ctx, ssh_server, 'runaway')
+
+    Dispatcher.dispatch({'type': 'stop', 'task_ids': ['runaway']}, Message())
+    assert ctx.mq.wait_reply('runaway')['code'] == ReCode.MANUAL_CANCELLED
+    # 远端命令的channel已关闭，被取消任务的连接不再放回连接池
+    assert open_channels(entry) == 0
+    assert remote_channels(ssh_server) == 0
+    assert entry not in pooled_entries(ctx)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from core.dispatch import Dispatcher
+from core.enums import ShellReplyCode as ReCode, TaskType
+
+from conftest import USERNAME, PASSWORD, Message
+
+
+@pytest.fixture
+def conf(conf):
+    return dict(conf, TARGET_CONFIG={'allow': ['127.0.0.0/8']})
+
+
+def fanout_body(task_id, port, hosts, cmd='echo ok'):
+    return {'id': task_id, 'type': TaskType.FANOUT, 'encoding': 'utf-8',
+            'account': {'username': USERNAME, 'password': PASSWORD},
+            'conn': {'hosts': hosts, 'port': port, 'proto': 'ssh'}, 'task': {'cmd': cmd}}
+
+
+def wait_done(mq, task_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        replies = mq.replies(task_id)
+        if replies and replies[-1].get('done'):
+            return replies[-1], {reply['host']: reply for reply in replies[:-1]}
+        time.sleep(0.02)
+    raise AssertionError('fanout task {} not done'.format(task_id))
+
+
+def test_fanout_hostname_targets(ctx, ssh_server):
+    hosts = ['localhost', 'db.example.internal', '10.0.0.1']
+    Dispatcher.dispatch(fanout_body('fan', ssh_server.port, hosts), Message())
+    done, replies = wait_done(ctx.mq, 'fan')
+    assert done['total'] == 2 and done['failed'] == 2
+    # localhost与Connection一样按127.0.0.1判断，在允许范围内正常执行
+    assert replies['localhost']['code'] == ReCode.SUCCESS
+    assert replies['localhost']['stdout'] == 'out:echo ok\n'
+    # 主机名不在调度前拒绝，交给每个连接的检查处理
+    assert replies['db.example.internal']['code'] == ReCode.UNKNOWN_ERROR
+    assert replies['db.example.internal']['err_info'] == 'Invalid ip'
+    assert replies['10.0.0.1']['code'] == ReCode.TARGET_DENIED
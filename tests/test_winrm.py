@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import httpx
+import pytest
+
+from core.dispatch import Dispatcher
+from core.enums import ShellReplyCode as ReCode
+from moudle.pool import PoolEntry
+
+from conftest import Message, gather_body
+
+
+class Protocol:
+    def __init__(self, error):
+        self.error = error
+        self.closed = []
+
+    async def open_shell(self):
+        return 'shell'
+
+    async def run_command(self, shell_id, cmd, args):
+        raise self.error
+
+    async def close_shell(self, shell_id, close_session=False):
+        self.closed.append(shell_id)
+
+
+class Client:
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.closed = False
+
+    async def open_shell(self):
+        return await self.protocol.open_shell()
+
+    async def release_shell(self, shell_id, reuse=True):
+        if not reuse:
+            await self.protocol.close_shell(shell_id)
+
+
+@pytest.fixture
+def winrm_session(ctx, monkeypatch):
+    # 替换连接池的获取与释放，返回模拟的WinRM会话
+    released = []
+
+    def use(error):
+        client = Client(Protocol(error))
+
+        async def acquire(connect_info, weight=1, **kwargs):
+            return PoolEntry(('127.0.0.1', 5985, 'u'), client)
+
+        async def release(entry, discard=False, weight=1):
+            released.append(discard)
+
+        monkeypatch.setattr(ctx.winrm_pool, 'acquire', acquire)
+        monkeypatch.setattr(ctx.winrm_pool, 'release', release)
+        return client, released
+
+    return use
+
+
+@pytest.mark.parametrize('error, code', [
+    (httpx.ReadTimeout('read timed out'), ReCode.HIT_EOF_TIME_OUT),
+    (httpx.ConnectTimeout('connect timed out'), ReCode.CONNECTION_TIME_OUT),
+])
+def test_timeouts(ctx, winrm_session, error, code):
+    client, released = winrm_session(error)
+    Dispatcher.dispatch(gather_body('w', 5985, 'ipconfig', proto='winrm'), Message())
+    assert ctx.mq.wait_reply('w')['code'] == code
+    # 超时的shell被关闭，会话不再放回连接池
+    assert client.protocol.closed == ['shell']
+    assert released == [True]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+RESULT_CONTENT_TYPE = 'application/x-know-arm-result'
+OUTPUT_FIELDS = ('stdout', 'stderr')
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# 按优先级排列，只包含当前环境可用的压缩算法
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compress, _zstd_decompress)
+if lz4_frame is not None:
+    CODECS['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+CODECS['zlib'] = (zlib.compress, zlib.decompress)
+
+
+def negotiate(accept):
+    # accept: 请求方可解压的算法，列表或逗号分隔字符串；返回双方都支持的最优算法
+    if not accept:
+        return None
+    if isinstance(accept, (bytes, bytearray)):
+        accept = accept.decode()
+    if isinstance(accept, str):
+        accept = accept.split(',')
+    accept = {str(codec).strip().lower() for codec in accept}
+    return next((codec for codec in CODECS if codec in accept), None)
+
+
+def compress(data, codec):
+    return CODECS[codec][0](data)
+
+
+def decompress(data, codec):
+    return CODECS[codec][1](data)
+
+
+def _iter_outputs(res):
+    # (结果序号, 字段)，-1表示顶层结果，其他为多命令结果中的序号
+    for field in OUTPUT_FIELDS:
+        yield -1, res, field
+    for i, item in enumerate(res.get('results') or ()):
+        for field in OUTPUT_FIELDS:
+            yield i, item, field
+
+
+def raw_size(res):
+    return sum(len(item[field]) for _, item, field in _iter_outputs(res) if isinstance(item.get(field), bytes))
+
+
+def pack_result(res, codec):
+    # 原始输出按顺序拼接后压缩作为消息体，其余字段以json放在消息头中
+    meta = json.loads(json.dumps(res, default=lambda o: ''))
+    segments, chunks = [], []
+    for index, item, field in _iter_outputs(res):
+        data = item.get(field)
+        if isinstance(data, bytes):
+            segments.append([index, field, len(data)])
+            chunks.append(data)
+    headers = {'x-result': json.dumps(meta), 'x-segments': json.dumps(segments)}
+    return compress(b''.join(chunks), codec), headers
+
+
+def unpack_result(body, headers, codec):
+    res = json.loads(headers['x-result'])
+    data = decompress(body, codec)
+    offset = 0
+    for index, field, length in json.loads(headers['x-segments']):
+        item = res if index < 0 else res['results'][index]
+        item[field] = data[offset:offset + length]
+        offset += length
+    return res
@@ -1,21 +1,142 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import codecs
 import logging
+import time
+from collections import OrderedDict
+from threading import Lock
 
 logger = logging.getLogger(__name__)
 
+# 编码检测只取输出开头的一段，避免对大输出整体检测
+DETECT_SAMPLE_SIZE = 4096
+
 
 def bytes2base64(b: bytes):
     return base64.b64encode(b)
 
 
-def bytes_decode(b: bytes, default='utf-8') -> str:
+def detect_encoding(b: bytes, sample_size=DETECT_SAMPLE_SIZE):
     import cchardet
+    return cchardet.detect(bytes(b[:sample_size]))['encoding']
+
+
+class EncodingCache:
+    # 按主机(per_command时再按命令)记录检测出的编码，同一设备的输出编码基本不变，之后无需再次检测
+    def __init__(self, ttl=3600, max_size=10000, per_command=False, sample_size=DETECT_SAMPLE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.per_command = per_command
+        self.sample_size = sample_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def key(self, host, cmd=None):
+        return (host, cmd) if self.per_command else host
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            encoding, expires = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return encoding
+
+    def set(self, key, encoding):
+        with self._lock:
+            self._items[key] = (encoding, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            # 超过容量时淘汰最久未使用的
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+def bytes_decode(b: bytes, default='utf-8', cache=None, key=None) -> str:
+    # 依次尝试默认编码、缓存中该主机的编码，都失败时才检测编码并记入缓存
+    learned = cache.get(key) if cache is not None else None
+    for code in (default, learned):
+        if code:
+            try:
+                return b.decode(code)
+            except (UnicodeDecodeError, LookupError):
+                pass
+    code = detect_encoding(b, cache.sample_size if cache is not None else DETECT_SAMPLE_SIZE)
     try:
-        res = b.decode(default)
-    except Exception:
-        detect = cchardet.detect(b)
-        code = detect['encoding']
         res = b.decode(code)
+    except (UnicodeDecodeError, LookupError, TypeError):
+        # 开头的样本不足以判断时退回到对整个输出检测
+        code = detect_encoding(b, len(b))
+        res = b.decode(code)
+    if cache is not None:
+        cache.set(key, code)
     return res
+
+
+class StreamDecoder:
+    # 分片输出的增量解码，多字节字符跨分片时不会被截断。默认编码与缓存中的编码都无法解码时，
+    # 攒够min_sample字节再检测，避免用很小的分片判断编码
+    __slots__ = ('default', 'cache', 'key', 'min_sample', 'encoding', 'decoder', 'pending', 'failed')
+
+    def __init__(self, default='utf-8', cache=None, key=None, min_sample=512):
+        self.default = default
+        self.cache = cache
+        self.key = key
+        self.min_sample = min_sample
+        self.encoding = None
+        self.decoder = None
+        self.pending = b''
+        # 中途解码失败而放弃的编码
+        self.failed = None
+
+    def choose(self, data, final=False):
+        learned = self.cache.get(self.key) if self.cache is not None else None
+        for code in (self.default, learned):
+            if code and code != self.failed:
+                try:
+                    codecs.getincrementaldecoder(code)().decode(data, final)
+                    return code
+                except (UnicodeDecodeError, LookupError):
+                    pass
+        if len(data) < self.min_sample and not final:
+            return None
+        code = detect_encoding(data, self.cache.sample_size if self.cache is not None else DETECT_SAMPLE_SIZE)
+        if not code:
+            return self.default or 'utf-8'
+        if self.cache is not None:
+            self.cache.set(self.key, code)
+        return code
+
+    def decode(self, data, final=False):
+        if self.decoder is None:
+            self.pending += data
+            if not self.pending:
+                return ''
+            code = self.choose(self.pending, final)
+            if code is None:
+                return ''
+            data, self.pending = self.pending, b''
+            self.encoding = code
+            # 重新选择过编码后，个别无法解码的字节直接替换，不再中断
+            self.decoder = codecs.getincrementaldecoder(code)(errors='replace' if self.failed else 'strict')
+        buffered = self.decoder.getstate()[0]
+        try:
+            return self.decoder.decode(data, final)
+        except UnicodeDecodeError:
+            # 开头为纯ASCII时可能选中了错误的编码，从当前分片起重新选择一次
+            self.failed, self.decoder, self.pending = self.encoding, None, buffered
+            return self.decode(data, final)
+
+    def flush(self):
+        return self.decode(b'', True)
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import ipaddress
 import logging
+from bisect import bisect_right
+from functools import lru_cache
 
 from IPy import IP
 
 logger = logging.getLogger(__name__)
 
 
+class TargetDenied(ValueError):
+    pass
+
+
 def is_ip(target):
     try:
         res = IP(target)
@@ -15,17 +22,129 @@ def is_ip(target):
         return False
 
 
-def is_ipv6(target):
+@lru_cache(maxsize=65536)
+def _address(target):
     try:
-        tmp = is_ip(target)
-        return tmp and tmp.version() == 6
-    except Exception:
-        return False
+        return ipaddress.ip_address(target)
+    except ValueError:
+        return None
 
 
-def is_ipv4(target):
+def address(target):
+    # 解析单个ip并缓存，非法时返回None
+    if isinstance(target, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return target
     try:
-        tmp = is_ip(target)
-        return tmp and tmp.version() == 4
-    except Exception:
-        return False
+        return _address(str(target).strip())
+    except TypeError:
+        return None
+
+
+def is_ipv6(target):
+    ip = address(target)
+    return ip is not None and ip.version == 6
+
+
+def is_ipv4(target):
+    ip = address(target)
+    return ip is not None and ip.version == 4
+
+
+def target_range(target):
+    # 单个ip、CIDR或区间转换为(版本, 起始整数, 结束整数)，CIDR包含网络与广播地址
+    target = str(target).strip()
+    if '/' in target:
+        network = ipaddress.ip_network(target, strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+    if '-' in target:
+        start, end = (x.strip() for x in target.split('-', 1))
+        start = ipaddress.ip_address(start)
+        if start.version == 4 and end.isdigit():
+            end = str(start).rsplit('.', 1)[0] + '.' + end
+        end = ipaddress.ip_address(end)
+        if end.version != start.version or end < start:
+            raise ValueError('Invalid ip range %s' % target)
+        return start.version, int(start), int(end)
+    ip = ipaddress.ip_address(target)
+    return ip.version, int(ip), int(ip)
+
+
+class IPSet:
+    # 由ip、CIDR、区间构建的有序不重叠区间表，成员判断为二分查找
+    __slots__ = ('_starts', '_ends')
+
+    def __init__(self, targets=()):
+        if isinstance(targets, str):
+            targets = [targets]
+        ranges = {4: [], 6: []}
+        for target in targets or ():
+            version, start, end = target_range(target)
+            ranges[version].append((start, end))
+        self._starts = {}
+        self._ends = {}
+        for version, items in ranges.items():
+            # 合并重叠与相邻的区间
+            merged = []
+            for start, end in sorted(items):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [start for start, _ in merged]
+            self._ends[version] = [end for _, end in merged]
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def __contains__(self, target):
+        ip = address(target)
+        return ip is not None and self.contains(ip.version, int(ip))
+
+    def contains(self, version, value):
+        i = bisect_right(self._starts[version], value) - 1
+        return i >= 0 and value <= self._ends[version][i]
+
+
+class TargetPolicy:
+    # 允许与禁止访问的网段，deny优先；allow为空时允许所有未被禁止的地址
+    __slots__ = ('allow', 'deny')
+
+    def __init__(self, allow=None, deny=None):
+        self.allow = IPSet(allow) if allow else None
+        self.deny = IPSet(deny) if deny else None
+
+    def permits(self, target):
+        ip = address(target)
+        if ip is None:
+            return False
+        version, value = ip.version, int(ip)
+        if self.deny is not None and self.deny.contains(version, value):
+            return False
+        return self.allow is None or self.allow.contains(version, value)
+
+
+def iter_target(target):
+    # 惰性展开单个目标：ip、CIDR(10.0.0.0/24)、区间(10.0.0.1-10.0.0.9 或 10.0.0.1-9)
+    target = str(target).strip()
+    if '/' in target:
+        network = ipaddress.ip_network(target, strict=False)
+        if network.version != 4:
+            raise ValueError('Not support ipv6 yet')
+        hosts = network.hosts() if network.num_addresses > 2 else iter(network)
+        for ip in hosts:
+            yield str(ip)
+    elif '-' in target:
+        version, start, end = target_range(target)
+        if version != 4:
+            raise ValueError('Not support ipv6 yet')
+        for ip in range(start, end + 1):
+            yield str(ipaddress.IPv4Address(ip))
+    else:
+        yield target
+
+
+def iter_targets(targets):
+    if isinstance(targets, str):
+        targets = [targets]
+    for target in targets:
+        yield from iter_target(target)
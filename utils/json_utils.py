@@ -1,25 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import json
+import sys
 from datetime import datetime, date
 from uuid import UUID
 
-import numpy as np
+
+def to_builtin(obj):
+    # json不支持的类型转换为内置类型，供MsgEncoder及其他序列化器的default回调使用
+    # numpy未被导入时不可能出现numpy类型，无需为此在启动时导入numpy
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj, np.integer):
+        return int(obj)
+    elif np is not None and isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, datetime):
+        return obj.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(obj, date):
+        return obj.strftime('%Y-%m-%d')
+    elif np is not None and isinstance(obj, type(np.ndarray)):
+        return obj.tolist()
+    elif isinstance(obj, UUID):
+        return obj.hex
+    elif isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    raise TypeError('Object of type {} is not JSON serializable'.format(obj.__class__.__name__))
 
 
 class MsgEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, datetime):
-            return obj.strftime('%Y-%m-%d %H:%M:%S')
-        elif isinstance(obj, date):
-            return obj.strftime('%Y-%m-%d')
-        elif isinstance(obj, type(np.ndarray)):
-            return obj.tolist()
-        elif isinstance(obj, UUID):
-            return obj.hex
-        else:
+        try:
+            return to_builtin(obj)
+        except TypeError:
             return json.JSONEncoder.default(self, obj)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# 各协议依赖的第三方库，预热时可用协议名代替模块名
+PROTOCOL_MODULES = {
+    'ssh': ('asyncssh',),
+    'telnet': ('telnetlib3',),
+    'winrm': ('httpx', 'asyncwinrm', 'asyncwinrm.exceptions'),
+}
+
+
+class LazyModule:
+    # 第一次访问属性时才导入模块，启动时不加载用不到的协议库
+    __slots__ = ('_name', '_module')
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module {!r}{}>'.format(self._name, '' if self._module is None else ' (loaded)')
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def prewarm(names):
+    # names: 协议名或模块名，返回各模块的导入耗时(秒)，导入失败的模块记录日志后跳过
+    cost = {}
+    for name in names or ():
+        for module in PROTOCOL_MODULES.get(name, (name,)):
+            start = time.perf_counter()
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                logger.warning('Failed to prewarm module {}: {}'.format(module, e))
+                continue
+            cost[module] = round(time.perf_counter() - start, 6)
+    return cost
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import json
+from uuid import UUID
+
+from utils.json_utils import MsgEncoder, to_builtin
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+class Format:
+    __slots__ = ('name', 'content_type', 'content_encoding', 'dumps', 'loads')
+
+    def __init__(self, name, content_type, content_encoding, dumps, loads):
+        self.name = name
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _json_dumps(data):
+    return json.dumps(data, cls=MsgEncoder).encode('utf-8')
+
+
+def _json_loads(body):
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        body = bytes(body).decode('utf-8')
+    return json.loads(body)
+
+
+def _has_uuid(obj):
+    # 只深入容器检查，字符串等标量直接跳过，不含UUID的常见回复无需复制
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(key, UUID) or (type(value) is not str and _has_uuid(value)):
+                return True
+        return False
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            if type(item) is not str and _has_uuid(item):
+                return True
+        return False
+    return isinstance(obj, UUID)
+
+
+def _hex_uuids(obj):
+    # orjson总是把UUID输出为带连字符的标准格式且不经过default，先转换为与MsgEncoder一致的hex
+    if isinstance(obj, dict):
+        return {(k.hex if isinstance(k, UUID) else k): _hex_uuids(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_hex_uuids(item) for item in obj]
+    if isinstance(obj, UUID):
+        return obj.hex
+    return obj
+
+
+if orjson is not None:
+    # 日期交给to_builtin处理，UUID预先转换为hex，与MsgEncoder输出格式一致
+    _ORJSON_OPTION = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def _orjson_dumps(data):
+        if _has_uuid(data):
+            data = _hex_uuids(data)
+        return orjson.dumps(data, default=to_builtin, option=_ORJSON_OPTION)
+
+    def _orjson_loads(body):
+        return orjson.loads(bytes(body) if isinstance(body, memoryview) else body)
+
+
+if msgpack is not None:
+    def _msgpack_dumps(data):
+        return msgpack.packb(data, default=to_builtin, use_bin_type=True)
+
+    def _msgpack_loads(body):
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+
+
+# 同一格式优先使用已安装的快速实现，未安装时退回标准库json
+FORMATS = {JSON: Format(JSON, 'application/json', 'utf-8', _orjson_dumps, _orjson_loads) if orjson is not None
+           else Format(JSON, 'application/json', 'utf-8', _json_dumps, _json_loads)}
+if msgpack is not None:
+    FORMATS[MSGPACK] = Format(MSGPACK, 'application/x-msgpack', 'binary', _msgpack_dumps, _msgpack_loads)
+
+CONTENT_TYPES = {'application/json': JSON, 'text/json': JSON,
+                 'application/x-msgpack': MSGPACK, 'application/msgpack': MSGPACK}
+
+
+def format_of(content_type):
+    # 按content-type查找可用的格式，未声明或不支持时返回None
+    if not content_type:
+        return None
+    name = CONTENT_TYPES.get(str(content_type).split(';')[0].strip().lower())
+    return name if name in FORMATS else None
+
+
+def reply_format(message=None, default=JSON):
+    # 回复与任务消息使用相同的格式，任务消息未声明格式时使用默认格式
+    name = format_of(getattr(message, 'content_type', None)) or default
+    return name if name in FORMATS else JSON
+
+
+def dumps(data, fmt=JSON):
+    # 返回(消息体, content_type, content_encoding)
+    f = FORMATS[fmt]
+    return f.dumps(data), f.content_type, f.content_encoding
+
+
+def loads(body, content_type=None):
+    # 未声明content-type的消息按json解析，兼容现有的生产者
+    return FORMATS[format_of(content_type) or JSON].loads(body)